@@ -0,0 +1,178 @@
+import logging
+from collections import namedtuple
+
+import numpy as np
+
+from fit_decoder import iter_messages, iter_stream_messages, FitDecodeError
+from spool import ChunkSpool
+
+__log__ = logging.getLogger(__name__)
+
+RECORD_CHUNK_SIZE = 8192
+SPLIT_DISTANCE = 100
+
+RECORD_FIELDS = ('timestamp', 'distance', 'enhanced_speed', 'heart_rate')
+
+# fastest_split is the seconds taken for the fastest split_distance metres, pace_variability the coefficient of
+# variation of speed, heart_rate_drift the relative change in heart rate from the first to the second half and
+# time_to_target_pace the seconds until the speed first reached the bottom of the target range
+RepeatAnalysis = namedtuple('RepeatAnalysis', ['split_distance', 'fastest_split', 'pace_variability',
+                                               'heart_rate_drift', 'time_to_target_pace'])
+
+RepeatInterval = namedtuple('RepeatInterval', ['start_time', 'end_time', 'work_step', 'repeat'])
+
+
+def _get_columns(rows, message):
+    # Invalid values become NaN, so the columns can be used without checking each record
+    values = np.array(rows, dtype=np.float64)
+    columns = []
+    for field_name in RECORD_FIELDS:
+        column = message.field_column(field_name)
+        if column is None:
+            columns.append(np.full(len(rows), np.nan))
+            continue
+
+        index, invalid, scale = column
+        column_values = values[:, index]
+        column_values[column_values == invalid] = np.nan
+        columns.append(column_values / scale)
+    return columns
+
+
+def _iter_record_messages(file):
+    if isinstance(file, ChunkSpool):
+        return iter_stream_messages(file.iter_chunks(), ('record',))
+    return iter_messages(file, ('record',))
+
+
+def iter_record_chunks(file, chunk_size=RECORD_CHUNK_SIZE):
+    # Records are decoded into arrays of timestamp, distance, speed and heart rate at most chunk_size records
+    # at a time, so memory does not grow with the length of the file. Records without a timestamp are dropped.
+    rows = []
+    first_message = None
+    accessors = None
+    for message in _iter_record_messages(file):
+        # Rows are only stacked with rows of the same definition, as the field positions can differ
+        if message.accessors is not accessors or len(rows) >= chunk_size:
+            if rows:
+                yield _get_columns(rows, first_message)
+            rows = []
+            first_message = message
+            accessors = message.accessors
+
+        rows.append(message.raw_values)
+
+    if rows:
+        yield _get_columns(rows, first_message)
+
+
+def _iter_valid_record_chunks(file, chunk_size):
+    for timestamps, distances, speeds, heart_rates in iter_record_chunks(file, chunk_size):
+        valid = ~np.isnan(timestamps)
+        if valid.any():
+            yield timestamps[valid], distances[valid], speeds[valid], heart_rates[valid]
+
+
+def get_repeat_intervals(workout):
+    intervals = []
+    for work_step in workout.work_steps.values():
+        for repeat in work_step.repeats:
+            start_times = [x.start_time for x in repeat.laps if x.start_time is not None]
+            end_times = [x.end_time for x in repeat.laps if x.end_time is not None]
+            if start_times and end_times:
+                intervals.append(RepeatInterval(min(start_times), max(end_times), work_step, repeat))
+    return sorted(intervals, key=lambda x: x.start_time)
+
+
+def get_fastest_split(timestamps, distances, split_distance=SPLIT_DISTANCE):
+    # The time at which each record's distance plus split_distance is reached, interpolated between records
+    distances = np.maximum.accumulate(distances)
+    starts = distances <= distances[-1] - split_distance
+    if not starts.any():
+        return None
+
+    split_times = np.interp(distances[starts] + split_distance, distances, timestamps) - timestamps[starts]
+    return float(split_times.min())
+
+
+def get_pace_variability(speeds):
+    speeds = speeds[speeds > 0]
+    if len(speeds) < 2:
+        return None
+    return float(speeds.std() / speeds.mean())
+
+
+def get_heart_rate_drift(timestamps, heart_rates):
+    middle = (timestamps[0] + timestamps[-1]) / 2
+    first_half = heart_rates[(timestamps <= middle) & ~np.isnan(heart_rates)]
+    second_half = heart_rates[(timestamps > middle) & ~np.isnan(heart_rates)]
+    if len(first_half) == 0 or len(second_half) == 0:
+        return None
+    return float(second_half.mean() / first_half.mean() - 1)
+
+
+def get_time_to_target_pace(timestamps, speeds, target_speed, start_time):
+    on_target = speeds >= target_speed
+    if not on_target.any():
+        return None
+    return float(timestamps[on_target.argmax()] - start_time)
+
+
+def analyse_repeat(interval, timestamps, distances, speeds, heart_rates):
+    fastest_split = None
+    valid_distances = ~np.isnan(distances)
+    if valid_distances.sum() >= 2:
+        fastest_split = get_fastest_split(timestamps[valid_distances], distances[valid_distances])
+
+    time_to_target_pace = None
+    work_step = interval.work_step
+    if work_step.target_type == 'speed' and work_step.target_low is not None:
+        time_to_target_pace = get_time_to_target_pace(timestamps, speeds, work_step.target_low, interval.start_time)
+
+    return RepeatAnalysis(SPLIT_DISTANCE,
+                          fastest_split,
+                          get_pace_variability(speeds[~np.isnan(speeds)]),
+                          get_heart_rate_drift(timestamps, heart_rates),
+                          time_to_target_pace)
+
+
+def _finish_repeat(interval, parts):
+    if parts:
+        interval.repeat.analysis = analyse_repeat(interval, *map(np.concatenate, zip(*parts)))
+
+
+def analyse_workout(file, workout, chunk_size=RECORD_CHUNK_SIZE):
+    # Sets the analysis of every repeat with lap times from the records within its laps. Records are read in
+    # time order, so only the records of the repeats still open at the current chunk are held.
+    # The analysis is optional, so a file the fast decoder can not read only loses the analysis of later repeats.
+    intervals = get_repeat_intervals(workout)
+    next_interval = 0
+    open_intervals = []
+
+    try:
+        for chunk in _iter_valid_record_chunks(file, chunk_size):
+            timestamps = chunk[0]
+            while next_interval < len(intervals) and intervals[next_interval].start_time <= timestamps[-1]:
+                open_intervals.append((intervals[next_interval], []))
+                next_interval += 1
+
+            still_open_intervals = []
+            for interval, parts in open_intervals:
+                start = np.searchsorted(timestamps, interval.start_time, 'left')
+                end = np.searchsorted(timestamps, interval.end_time, 'right')
+                if end > start:
+                    parts.append([x[start:end] for x in chunk])
+
+                if timestamps[-1] >= interval.end_time:
+                    _finish_repeat(interval, parts)
+                else:
+                    still_open_intervals.append((interval, parts))
+            open_intervals = still_open_intervals
+    except FitDecodeError:
+        __log__.warning("Failed to decode the records for the analysis", exc_info=True)
+        return workout
+
+    for interval, parts in open_intervals:
+        _finish_repeat(interval, parts)
+
+    return workout
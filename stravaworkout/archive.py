@@ -0,0 +1,290 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import zlib
+
+from spool import ChunkSpool, READ_CHUNK_SIZE
+
+__log__ = logging.getLogger(__name__)
+
+CODECS = ('zlib', 'lzma')
+DEFAULT_CODEC = 'zlib'
+
+INDEX_FILE = 'index.sqlite'
+PACK_FILE = 'fit.{generation}.pack'
+
+# The files are in the pack of the latest generation, the previous one is kept for readers that looked up an
+# offset before the compaction that replaced it
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    content_hash TEXT PRIMARY KEY,
+    offset INTEGER NOT NULL,
+    compressed_size INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    codec TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS packs (
+    generation INTEGER PRIMARY KEY
+);
+
+INSERT OR IGNORE INTO packs (generation) VALUES (0);
+'''
+
+CURRENT_GENERATION = '(SELECT max(generation) FROM packs)'
+
+
+def get_compressor(codec):
+    if codec == 'zlib':
+        return zlib.compressobj(9)
+    elif codec == 'lzma':
+        # Only loaded when asked for, zlib is the default
+        import lzma
+        return lzma.LZMACompressor()
+    else:
+        raise ValueError(f"Unknown codec \"{codec}\"")
+
+
+def get_decompressor(codec):
+    if codec == 'zlib':
+        return zlib.decompressobj()
+    elif codec == 'lzma':
+        import lzma
+        return lzma.LZMADecompressor()
+    else:
+        raise ValueError(f"Unknown codec \"{codec}\"")
+
+
+class FitArchive:
+    # FIT files stored once under the SHA-256 of their content, the same hash as ChunkSpool.content_hash.
+    # Each file is compressed on its own and appended to one pack file, so any one of them can be streamed back
+    # without reading the others. The SQLite index says where each file is, and its write lock also keeps
+    # processes sharing the archive from appending to the pack at the same time.
+    # Compaction writes a new pack rather than replacing the one other processes may be reading.
+    def __init__(self, directory, codec=DEFAULT_CODEC):
+        get_compressor(codec)
+        os.makedirs(directory, exist_ok=True)
+
+        self.codec = codec
+        self.directory = directory
+        # Transactions are begun explicitly, as the pack is written inside them
+        self.connection = sqlite3.connect(os.path.join(directory, INDEX_FILE), timeout=60, isolation_level=None,
+                                          check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def __contains__(self, content_hash):
+        return self.get_entry(content_hash) is not None
+
+    def get_pack_path(self, generation):
+        return os.path.join(self.directory, PACK_FILE.format(generation=generation))
+
+    def get_generation(self):
+        with self.lock:
+            return self.connection.execute(f'SELECT {CURRENT_GENERATION}').fetchone()[0]
+
+    def get_entry(self, content_hash):
+        # The generation is read in the same query, so the offset is always for the pack it was looked up in
+        with self.lock:
+            return self.connection.execute(
+                f'SELECT offset, compressed_size, size, codec, {CURRENT_GENERATION} FROM files '
+                f'WHERE content_hash = ?', (content_hash,)).fetchone()
+
+    def put(self, content_hash, chunks):
+        # Returns whether the file was added, a file already in the archive is not compressed again
+        if content_hash in self:
+            return False
+
+        compressor = get_compressor(self.codec)
+        file_hash = hashlib.sha256()
+        size = 0
+        compressed = []
+        for chunk in chunks:
+            file_hash.update(chunk)
+            size += len(chunk)
+            compressed.append(compressor.compress(chunk))
+        compressed.append(compressor.flush())
+        if file_hash.hexdigest() != content_hash:
+            raise ValueError(f"Content hash {file_hash.hexdigest()} does not match {content_hash}")
+
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                # Another process may have added it while this one was compressing
+                if self.connection.execute('SELECT 1 FROM files WHERE content_hash = ?', (content_hash,)).fetchone():
+                    self.connection.execute('ROLLBACK')
+                    return False
+
+                # A write cut short leaves bytes after the last indexed file, which compact removes
+                generation, = self.connection.execute(f'SELECT {CURRENT_GENERATION}').fetchone()
+                with open(self.get_pack_path(generation), 'ab') as f:
+                    offset = f.seek(0, 2)
+                    f.writelines(compressed)
+                self.connection.execute(
+                    'INSERT INTO files (content_hash, offset, compressed_size, size, codec) VALUES (?, ?, ?, ?, ?)',
+                    (content_hash, offset, sum(map(len, compressed)), size, self.codec))
+                self.connection.execute('COMMIT')
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+
+        return True
+
+    def iter_chunks(self, content_hash):
+        entry = self.get_entry(content_hash)
+        if entry is None:
+            raise KeyError(content_hash)
+
+        offset, compressed_size, _, codec, generation = entry
+        decompressor = get_decompressor(codec)
+        with open(self.get_pack_path(generation), 'rb') as f:
+            f.seek(offset)
+            remaining = compressed_size
+            while remaining > 0:
+                data = f.read(min(READ_CHUNK_SIZE, remaining))
+                if not data:
+                    raise ValueError(f"Archived file {content_hash} is cut short")
+                remaining -= len(data)
+                chunk = decompressor.decompress(data)
+                if chunk:
+                    yield chunk
+
+        if codec == 'zlib':
+            chunk = decompressor.flush()
+            if chunk:
+                yield chunk
+        if not decompressor.eof:
+            raise ValueError(f"Archived file {content_hash} is cut short")
+
+    def open(self, content_hash):
+        # Decompressed as it is read, so a decoder reading the spool's chunks starts before the whole file is out
+        return ChunkSpool(self.iter_chunks(content_hash))
+
+    def verify(self):
+        # Yields the content hash and problem of every file that does not decompress to its content hash
+        with self.lock:
+            entries = self.connection.execute('SELECT content_hash, size FROM files ORDER BY offset').fetchall()
+
+        for content_hash, size in entries:
+            file_hash = hashlib.sha256()
+            file_size = 0
+            try:
+                for chunk in self.iter_chunks(content_hash):
+                    file_hash.update(chunk)
+                    file_size += len(chunk)
+            except Exception as e:
+                # Damaged data fails differently in each codec
+                yield content_hash, f"{type(e).__name__}: {e}"
+                continue
+
+            if file_size != size:
+                yield content_hash, f"Size {file_size} does not match {size}"
+            elif file_hash.hexdigest() != content_hash:
+                yield content_hash, f"Content hash {file_hash.hexdigest()} does not match"
+
+    def stats(self):
+        with self.lock:
+            files, size, compressed_size = self.connection.execute(
+                'SELECT count(*), coalesce(sum(size), 0), coalesce(sum(compressed_size), 0) FROM files').fetchone()
+        pack_path = self.get_pack_path(self.get_generation())
+        pack_size = os.path.getsize(pack_path) if os.path.exists(pack_path) else 0
+        return {'files': files, 'size': size, 'compressed_size': compressed_size, 'pack_size': pack_size}
+
+    def compact(self, keep=None):
+        # Copies the files in keep, or all indexed files, to the pack of a new generation, dropping everything else
+        # such as the remains of interrupted writes. The compressed bytes are copied as they are.
+        # Readers of the previous pack are left to finish, it is removed by the next compaction.
+        # Returns the number of files removed and the bytes the pack shrank by.
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            new_path = None
+            try:
+                generation, = self.connection.execute(f'SELECT {CURRENT_GENERATION}').fetchone()
+                entries = self.connection.execute(
+                    'SELECT content_hash, offset, compressed_size FROM files ORDER BY offset').fetchall()
+                removed = [(x[0],) for x in entries if keep is not None and x[0] not in keep]
+                kept = [x for x in entries if keep is None or x[0] in keep]
+                stale = self.connection.execute('SELECT generation FROM packs WHERE generation < ?',
+                                                (generation,)).fetchall()
+
+                old_path = self.get_pack_path(generation)
+                old_size = os.path.getsize(old_path) if os.path.exists(old_path) else 0
+                new_path = self.get_pack_path(generation + 1)
+                offsets = []
+                with open(new_path, 'wb') as new_pack, open(old_path, 'ab+') as old_pack:
+                    for content_hash, offset, compressed_size in kept:
+                        old_pack.seek(offset)
+                        offsets.append((new_pack.tell(), content_hash))
+                        remaining = compressed_size
+                        while remaining > 0:
+                            data = old_pack.read(min(READ_CHUNK_SIZE, remaining))
+                            if not data:
+                                raise ValueError(f"Archived file {content_hash} is cut short")
+                            new_pack.write(data)
+                            remaining -= len(data)
+                    new_size = new_pack.tell()
+                    new_pack.flush()
+                    os.fsync(new_pack.fileno())
+
+                self.connection.executemany('DELETE FROM files WHERE content_hash = ?', removed)
+                self.connection.executemany('UPDATE files SET offset = ? WHERE content_hash = ?', offsets)
+                self.connection.execute('INSERT INTO packs (generation) VALUES (?)', (generation + 1,))
+                self.connection.executemany('DELETE FROM packs WHERE generation = ?', stale)
+                self.connection.execute('COMMIT')
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                if new_path is not None and os.path.exists(new_path):
+                    os.remove(new_path)
+                raise
+
+        for stale_generation, in stale:
+            stale_path = self.get_pack_path(stale_generation)
+            if os.path.exists(stale_path):
+                os.remove(stale_path)
+
+        return len(removed), old_size - new_size
+
+
+def archive_main(args):
+    from sync_state import SyncState
+
+    with FitArchive(args.archive, args.archive_codec) as archive:
+        if args.action == 'verify':
+            problems = 0
+            for content_hash, problem in archive.verify():
+                __log__.error("Archived file %s is damaged: %s", content_hash, problem)
+                problems += 1
+            stats = archive.stats()
+            print(f"Verified {stats['files']} files, {problems} damaged")
+            if problems:
+                raise SystemExit(1)
+        elif args.action == 'compact':
+            # Files of activities no longer in the state are dropped, unless every file is kept
+            keep = None
+            if not args.keep_unreferenced:
+                # A wrong --state would otherwise empty the archive
+                if os.path.exists(args.state):
+                    with SyncState(args.state) as state:
+                        keep = set(map(lambda x: x.content_hash, state.iter_activities()))
+                if not keep and archive.stats()['files']:
+                    __log__.error("No archived files are referenced by the state %s, check --state or pass "
+                                  "--keep-unreferenced to only drop the remains of interrupted writes", args.state)
+                    raise SystemExit(1)
+            removed, reclaimed = archive.compact(keep)
+            print(f"Removed {removed} files, reclaimed {reclaimed} bytes")
+        else:
+            stats = archive.stats()
+            print(f"{stats['files']} files, {stats['size']} bytes compressed to {stats['compressed_size']} bytes, "
+                  f"pack file {stats['pack_size']} bytes")
@@ -0,0 +1,103 @@
+import csv
+import functools
+import glob
+import json
+import logging
+import os
+import sys
+
+from renderer import WorkoutRenderer
+from workout_parser import create_workout
+
+__log__ = logging.getLogger(__name__)
+
+OUTPUT_FORMATS = ('csv', 'json')
+
+CSV_FIELDS = ['file', 'row_type', 'step_index', 'step_type', 'repeat', 'lap', 'distance', 'time', 'speed', 'pace',
+              'heart_rate', 'ascent', 'descent', 'fastest_split', 'pace_variability', 'heart_rate_drift',
+              'time_to_target_pace', 'title', 'description']
+
+
+def find_fit_files(paths):
+    # Directories are searched recursively, other paths may be globs for shells that do not expand them
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, _, filenames in sorted(os.walk(path)):
+                for filename in sorted(filenames):
+                    if filename.lower().endswith('.fit'):
+                        yield os.path.join(directory, filename)
+        else:
+            yield from sorted(glob.glob(path)) or [path]
+
+
+@functools.lru_cache(maxsize=None)
+def get_renderer(output_format, detail):
+    # One renderer per worker process, so its cached labels are shared by all the files the worker renders
+    if output_format == 'json':
+        return WorkoutRenderer(('json',), detail)
+    return WorkoutRenderer(('rows',), detail)
+
+
+def get_workout_records(path, workout, output_format='csv', detail='activity'):
+    if workout is None:
+        if output_format == 'json':
+            return [{'file': path}]
+        return [{'file': path, 'row_type': 'activity'}]
+
+    rendering = get_renderer(output_format, detail).render(workout)
+    if output_format == 'json':
+        return [dict(file=path, **rendering.data)]
+    return [dict(row, file=path) for row in rendering.rows]
+
+
+def process_fit_file(task):
+    path, decoder, detail, analysis, output_format = task
+    # One bad file should not stop a batch of thousands, so errors are passed back to be logged
+    try:
+        workout = create_workout(path, decoder)
+        if analysis and workout is not None:
+            from analysis import analyse_workout
+            analyse_workout(path, workout)
+        return path, get_workout_records(path, workout, output_format, detail), None
+    except Exception as e:
+        return path, None, f"{type(e).__name__}: {e}"
+
+
+def run_batch(paths, output, decoder='fast', detail='activity', workers=None, analysis=False, output_format='csv'):
+    tasks = ((path, decoder, detail, analysis, output_format) for path in find_fit_files(paths))
+
+    # JSON is written as one workout per line, so it can be streamed like the CSV rows
+    if output_format == 'json':
+        def write_records(records):
+            output.writelines(map(lambda x: json.dumps(x, ensure_ascii=False) + '\n', records))
+    else:
+        writer = csv.DictWriter(output, CSV_FIELDS)
+        writer.writeheader()
+        write_records = writer.writerows
+
+    # Loaded here as only the batch itself needs it, not the CLI startup
+    import multiprocessing
+
+    processed = 0
+    failed = 0
+    # Rows are written as each file finishes, so memory use does not grow with the number of files
+    with multiprocessing.Pool(workers) as pool:
+        for path, records, error in pool.imap_unordered(process_fit_file, tasks, chunksize=4):
+            if error is not None:
+                __log__.warning("Failed to process %s: %s", path, error)
+                failed += 1
+                continue
+
+            write_records(records)
+            processed += 1
+
+    __log__.info("Processed %d FIT files, %d failed", processed, failed)
+    return processed, failed
+
+
+def batch_main(args):
+    if args.output == '-':
+        run_batch(args.paths, sys.stdout, args.decoder, args.detail, args.workers, args.analysis, args.format)
+    else:
+        with open(args.output, 'w', newline='') as output:
+            run_batch(args.paths, output, args.decoder, args.detail, args.workers, args.analysis, args.format)
@@ -0,0 +1,217 @@
+import argparse
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+from fit_generator import generate_workout_fit
+from renderer import render_workout
+from workout_parser import DECODERS, WorkoutBuilder, build_workout, iter_workout_frames
+
+# case name -> generate_workout_fit arguments
+CASES = {
+    'small': dict(repeat_blocks=1, repeat_times=4),
+    'medium': dict(repeat_blocks=3, repeat_times=8, laps_per_step=2),
+    'nested': dict(repeat_blocks=2, repeat_times=4, nested_repeats=2),
+    'large': dict(repeat_blocks=10, repeat_times=20, laps_per_step=2),
+}
+
+STAGES = ('decode', 'build', 'laps', 'render')
+
+# Modules that are imported on their own at startup, and the modules they must only import when actually used
+STARTUP_MODULES = ('main',)
+LAZY_MODULES = ('stravalib', 'stravaweblib', 'fitdecode', 'multiprocessing', 'numpy')
+
+DEFAULT_REPEATS = 5
+DEFAULT_THRESHOLD = 1.2
+DEFAULT_IMPORT_BUDGET = 0.1
+
+
+def time_stages(data, decoder):
+    timings = {}
+
+    # Decoding is timed on its own, so the frames are gathered first rather than built as they arrive
+    start = time.perf_counter()
+    frames = list(iter_workout_frames(io.BytesIO(data), decoder))
+    timings['decode'] = time.perf_counter() - start
+
+    lap_frames = [x for x in frames if x.name == 'lap']
+    workout_step_frames = [x for x in frames if x.name != 'lap']
+
+    builder = WorkoutBuilder()
+    start = time.perf_counter()
+    for frame in workout_step_frames:
+        builder.add_frame(frame)
+    timings['build'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for frame in lap_frames:
+        builder.add_frame(frame)
+    workout = builder.finish()
+    timings['laps'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    render_workout(workout)
+    timings['render'] = time.perf_counter() - start
+
+    return timings, len(lap_frames), sum(map(lambda x: x.name == 'workout_step', workout_step_frames))
+
+
+def run_case(case, decoder, repeats=DEFAULT_REPEATS):
+    data = generate_workout_fit(**CASES[case])
+
+    samples = {stage: [] for stage in STAGES}
+    for _ in range(repeats):
+        timings, laps, workout_steps = time_stages(data, decoder)
+        for stage in STAGES:
+            samples[stage].append(timings[stage])
+
+    return {
+        'case': case,
+        'decoder': decoder,
+        'size': len(data),
+        'workout_steps': workout_steps,
+        'laps': laps,
+        'repeats': repeats,
+        'stages': {stage: {'min': min(x), 'median': statistics.median(x)} for stage, x in samples.items()},
+    }
+
+
+def measure_import(module):
+    # Imported in a fresh interpreter so nothing is loaded already, import times are in microseconds
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            cwd=os.path.dirname(os.path.abspath(__file__)),
+                            capture_output=True, text=True, check=True)
+
+    imported = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        imported[name.strip()] = int(cumulative) / 1000000
+
+    return imported[module], sorted(set(LAZY_MODULES) & imported.keys())
+
+
+def run_startup(module, repeats=DEFAULT_REPEATS):
+    samples = []
+    for _ in range(repeats):
+        seconds, lazy_modules = measure_import(module)
+        samples.append(seconds)
+
+    return {'min': min(samples), 'median': statistics.median(samples), 'lazy_modules': lazy_modules}
+
+
+def run_benchmarks(cases, decoders, repeats=DEFAULT_REPEATS):
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'startup': {module: run_startup(module, repeats) for module in STARTUP_MODULES},
+        'results': [run_case(case, decoder, repeats) for case in cases for decoder in decoders],
+    }
+
+
+def find_startup_problems(benchmarks, budget=DEFAULT_IMPORT_BUDGET):
+    problems = []
+    for module, startup in benchmarks['startup'].items():
+        if startup['median'] > budget:
+            problems.append(f"import {module} took {startup['median'] * 1000:.1f}ms, "
+                            f"over the {budget * 1000:.1f}ms budget")
+        if startup['lazy_modules']:
+            problems.append(f"import {module} loaded {str.join(', ', startup['lazy_modules'])}")
+    return problems
+
+
+def find_decoder_mismatches(cases):
+    # Every decoder must build the same workout, or a faster decoder is only faster by being wrong.
+    # The workouts are built without create_workout, which would fall back to fitdecode and hide a failure.
+    mismatches = []
+    for case in cases:
+        data = generate_workout_fit(**CASES[case])
+        renderings = {}
+        for decoder in DECODERS:
+            workout, _ = build_workout(iter_workout_frames(io.BytesIO(data), decoder))
+            renderings[decoder] = render_workout(workout, ('json',)).data
+        mismatches.extend((case, x) for x in DECODERS[1:] if renderings[x] != renderings[DECODERS[0]])
+    return mismatches
+
+
+def find_regressions(baseline, benchmarks, threshold=DEFAULT_THRESHOLD):
+    # Medians are compared for the cases and decoders present in both runs
+    baseline_results = {(x['case'], x['decoder']): x for x in baseline['results']}
+    regressions = []
+    for result in benchmarks['results']:
+        baseline_result = baseline_results.get((result['case'], result['decoder']))
+        if baseline_result is None:
+            continue
+
+        for stage, timing in result['stages'].items():
+            baseline_median = baseline_result['stages'].get(stage, {}).get('median')
+            if baseline_median and timing['median'] > baseline_median * threshold:
+                regressions.append((result['case'], result['decoder'], stage, baseline_median, timing['median']))
+
+    for module, startup in benchmarks.get('startup', {}).items():
+        baseline_median = baseline.get('startup', {}).get(module, {}).get('median')
+        if baseline_median and startup['median'] > baseline_median * threshold:
+            regressions.append((module, 'python', 'import', baseline_median, startup['median']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Time decoding, workout building, lap attribution and rendering on generated FIT files.'
+    )
+    parser.add_argument("--cases", nargs='+', choices=CASES, default=list(CASES),
+                        help="The generated workouts to time (default: all)")
+    parser.add_argument("--decoders", nargs='+', choices=DECODERS, default=['fast'],
+                        help="The FIT decoders to time (default: %(default)s)")
+    parser.add_argument("--repeats", type=int, default=DEFAULT_REPEATS,
+                        help="The number of times each case is timed (default: %(default)s)")
+    parser.add_argument("--output", "-o", default='-',
+                        help="The JSON file to write the results to (default: stdout)")
+    parser.add_argument("--compare",
+                        help="A JSON file from a previous run, exits with status 1 if any stage got slower")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="How many times slower than the previous run a stage may get (default: %(default)s)")
+    parser.add_argument("--import-budget", type=float, default=DEFAULT_IMPORT_BUDGET,
+                        help="The seconds the CLI may take to import, exits with status 1 if it takes longer "
+                             "or loads a module it should only load when used (default: %(default)s)")
+    args = parser.parse_args()
+
+    benchmarks = run_benchmarks(args.cases, args.decoders, args.repeats)
+
+    if args.output == '-':
+        json.dump(benchmarks, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as output:
+            json.dump(benchmarks, output, indent=2)
+
+    failed = False
+    for problem in find_startup_problems(benchmarks, args.import_budget):
+        print(problem, file=sys.stderr)
+        failed = True
+
+    for case, decoder in find_decoder_mismatches(args.cases):
+        print(f"{case}: {decoder} built a different workout than {DECODERS[0]}", file=sys.stderr)
+        failed = True
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = find_regressions(json.load(baseline_file), benchmarks, args.threshold)
+
+        for case, decoder, stage, baseline_median, median in regressions:
+            print(f"{case} ({decoder}) {stage}: {baseline_median * 1000:.3f}ms -> {median * 1000:.3f}ms",
+                  file=sys.stderr)
+            failed = True
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+import json
+import logging
+import os
+import stat
+
+__log__ = logging.getLogger(__name__)
+
+TOKEN_KEYS = ('access_token', 'refresh_token', 'expires_at')
+
+
+def get_owner(config):
+    # Saved credentials are only used with the application and account they were saved for
+    return {'client_id': config['api']['client_id'], 'email': config['user']['email']}
+
+
+def load_credentials(path, config):
+    try:
+        mode = os.stat(path).st_mode
+        with open(path, 'rt') as f:
+            credentials = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError:
+        __log__.warning("Ignored the unreadable credentials file %s", path)
+        return {}
+
+    if stat.S_IMODE(mode) & 0o077:
+        __log__.warning("The credentials file %s could be read by other users, restricting it to its owner", path)
+        os.chmod(path, 0o600)
+
+    owner = get_owner(config)
+    if any(map(lambda x: credentials.get(x) != owner[x], owner)):
+        return {}
+    return credentials
+
+
+def save_credentials(path, config, **values):
+    credentials = dict(load_credentials(path, config), **values, **get_owner(config))
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, 0o700, exist_ok=True)
+
+    # The tokens and session are as good as the password, so the file is never readable by anyone else,
+    # not even while it is written
+    temporary_path = f'{path}.tmp'
+    fd = os.open(temporary_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    os.fchmod(fd, 0o600)
+    with os.fdopen(fd, 'wt') as f:
+        json.dump(credentials, f)
+    os.replace(temporary_path, path)
+
+
+def get_tokens(credentials):
+    if any(map(lambda x: credentials.get(x) is None, TOKEN_KEYS)):
+        return None
+    return {key: credentials[key] for key in TOKEN_KEYS}
@@ -0,0 +1,62 @@
+import datetime
+import hashlib
+import json
+
+from workout_types import RepeatStep, WorkStep
+
+# Part of every fingerprint, so changing what goes into them does not match fingerprints made before
+FINGERPRINT_VERSION = 1
+
+
+def get_duration_value(duration):
+    if isinstance(duration, datetime.timedelta):
+        return duration.total_seconds()
+    return duration
+
+
+def iter_work_steps(steps):
+    # Work steps in the order of the tree, which is the same for every workout with the same fingerprint
+    for step in steps:
+        if isinstance(step, RepeatStep):
+            yield from iter_work_steps(step.steps)
+        else:
+            yield step
+
+
+def get_step_structure(step):
+    if isinstance(step, WorkStep):
+        return [step.step_type, step.duration_type, get_duration_value(step.duration),
+                step.target_type, step.target_zone, step.target_low, step.target_high]
+    elif isinstance(step, RepeatStep):
+        return ['repeat', step.repeat_times, [get_step_structure(x) for x in step.steps]]
+    else:
+        raise ValueError(f"type(step) = {type(step)}")
+
+
+def get_workout_fingerprint(workout):
+    # Step types, durations and targets of the step tree, but nothing of how it was run, so the same
+    # session on another day has the same fingerprint
+    structure = [FINGERPRINT_VERSION, [get_step_structure(x) for x in workout.steps]]
+    return hashlib.sha1(json.dumps(structure, separators=(',', ':')).encode()).hexdigest()
+
+
+def get_repeat_speed(repeat):
+    # Rests may cover no distance or have no speed at all
+    if not repeat.total_distance() or repeat.avg_speed() is None:
+        return None
+    return repeat.avg_speed()
+
+
+def get_work_step_speed(work_step):
+    total_seconds = sum(map(lambda x: x.total_seconds(), work_step.repeats))
+    speeds = list(map(get_repeat_speed, work_step.repeats))
+    if total_seconds <= 0 or None in speeds:
+        return None
+    return sum(map(lambda x, y: x * y.total_seconds(), speeds, work_step.repeats)) / total_seconds
+
+
+def get_session_metrics(workout):
+    # The average speed of each work step and of its repeats, in the order of iter_work_steps
+    return [{'speed': get_work_step_speed(work_step),
+             'repeats': list(map(get_repeat_speed, work_step.repeats))}
+            for work_step in iter_work_steps(workout.steps)]
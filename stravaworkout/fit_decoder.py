@@ -0,0 +1,460 @@
+import mmap
+import os
+import struct
+from collections import namedtuple
+
+FitField = namedtuple('FitField', ['name', 'value', 'raw_value'])
+
+
+class FitDecodeError(ValueError):
+    pass
+
+
+class MissingFieldError(ValueError):
+    pass
+
+
+_MISSING = object()
+
+
+WORKOUT_STEP_DURATION_TYPES = {
+    0: 'time', 1: 'distance', 2: 'hr_less_than', 3: 'hr_greater_than', 4: 'calories', 5: 'open',
+    6: 'repeat_until_steps_cmplt', 7: 'repeat_until_time', 8: 'repeat_until_distance', 9: 'repeat_until_calories',
+    10: 'repeat_until_hr_less_than', 11: 'repeat_until_hr_greater_than', 12: 'repeat_until_power_less_than',
+    13: 'repeat_until_power_greater_than', 14: 'power_less_than', 15: 'power_greater_than',
+    16: 'training_peaks_tss', 17: 'repeat_until_power_last_lap_less_than',
+    18: 'repeat_until_max_power_last_lap_less_than', 19: 'power_3s_less_than', 20: 'power_10s_less_than',
+    21: 'power_30s_less_than', 22: 'power_3s_greater_than', 23: 'power_10s_greater_than',
+    24: 'power_30s_greater_than', 25: 'power_lap_less_than', 26: 'power_lap_greater_than',
+    27: 'repeat_until_training_peaks_tss', 28: 'repetition_time', 29: 'reps', 31: 'time_only',
+}
+
+WORKOUT_STEP_TARGET_TYPES = {
+    0: 'speed', 1: 'heart_rate', 2: 'open', 3: 'cadence', 4: 'power', 5: 'grade', 6: 'resistance',
+    7: 'power_3s', 8: 'power_10s', 9: 'power_30s', 10: 'power_lap', 11: 'swim_stroke', 12: 'speed_lap',
+    13: 'heart_rate_lap',
+}
+
+INTENSITIES = {
+    0: 'active', 1: 'rest', 2: 'warmup', 3: 'cooldown', 4: 'recovery', 5: 'interval', 6: 'other',
+}
+
+# global message number -> (message name, {field number: (field name, scale, enum values)})
+MESSAGE_PROFILES = {
+    0: ('file_id', {
+        0: ('type', 1, None),
+    }),
+    3: ('user_profile', {
+        4: ('weight', 10, None),
+    }),
+    19: ('lap', {
+        2: ('start_time', 1, None),
+        7: ('total_elapsed_time', 1000, None),
+        8: ('total_timer_time', 1000, None),
+        9: ('total_distance', 100, None),
+        13: ('avg_speed', 1000, None),
+        15: ('avg_heart_rate', 1, None),
+        21: ('total_ascent', 1, None),
+        22: ('total_descent', 1, None),
+        71: ('wkt_step_index', 1, None),
+        110: ('enhanced_avg_speed', 1000, None),
+        253: ('timestamp', 1, None),
+        254: ('message_index', 1, None),
+    }),
+    20: ('record', {
+        3: ('heart_rate', 1, None),
+        5: ('distance', 100, None),
+        6: ('speed', 1000, None),
+        73: ('enhanced_speed', 1000, None),
+        253: ('timestamp', 1, None),
+    }),
+    27: ('workout_step', {
+        1: ('duration_type', 1, WORKOUT_STEP_DURATION_TYPES),
+        2: ('duration_value', 1, None),
+        3: ('target_type', 1, WORKOUT_STEP_TARGET_TYPES),
+        4: ('target_value', 1, None),
+        5: ('custom_target_value_low', 1, None),
+        6: ('custom_target_value_high', 1, None),
+        7: ('intensity', 1, INTENSITIES),
+        254: ('message_index', 1, None),
+    }),
+}
+
+# message name -> {field name: [(reference field name, reference values, subfield name, scale)]}
+# Subfields are tried in the same order as the fitdecode profile, the first match wins.
+_REPEAT_UNTIL_DURATION_TYPES = ('repeat_until_steps_cmplt', 'repeat_until_time', 'repeat_until_distance',
+                                'repeat_until_calories', 'repeat_until_hr_less_than',
+                                'repeat_until_hr_greater_than', 'repeat_until_power_less_than',
+                                'repeat_until_power_greater_than')
+
+SUBFIELDS = {
+    'workout_step': {
+        'duration_value': [
+            ('duration_type', ('calories',), 'duration_calories', 1),
+            ('duration_type', ('distance',), 'duration_distance', 100),
+            ('duration_type', ('hr_less_than', 'hr_greater_than'), 'duration_hr', 1),
+            ('duration_type', ('power_less_than', 'power_greater_than'), 'duration_power', 1),
+            ('duration_type', ('reps',), 'duration_reps', 1),
+            ('duration_type', _REPEAT_UNTIL_DURATION_TYPES, 'duration_step', 1),
+            ('duration_type', ('time', 'repetition_time'), 'duration_time', 1000),
+        ],
+        'target_value': [
+            ('duration_type', ('repeat_until_calories',), 'repeat_calories', 1),
+            ('duration_type', ('repeat_until_distance',), 'repeat_distance', 100),
+            ('duration_type', ('repeat_until_hr_less_than', 'repeat_until_hr_greater_than'), 'repeat_hr', 1),
+            ('duration_type', ('repeat_until_power_less_than', 'repeat_until_power_greater_than'),
+             'repeat_power', 1),
+            ('duration_type', ('repeat_until_steps_cmplt',), 'repeat_steps', 1),
+            ('duration_type', ('repeat_until_time',), 'repeat_time', 1000),
+            ('target_type', ('cadence',), 'target_cadence_zone', 1),
+            ('target_type', ('heart_rate',), 'target_hr_zone', 1),
+            ('target_type', ('power',), 'target_power_zone', 1),
+            ('target_type', ('speed',), 'target_speed_zone', 1),
+            ('target_type', ('swim_stroke',), 'target_stroke_type', 1),
+        ],
+        'custom_target_value_low': [
+            ('target_type', ('cadence',), 'custom_target_cadence_low', 1),
+            ('target_type', ('heart_rate',), 'custom_target_heart_rate_low', 1),
+            ('target_type', ('power',), 'custom_target_power_low', 1),
+            ('target_type', ('speed',), 'custom_target_speed_low', 1000),
+        ],
+        'custom_target_value_high': [
+            ('target_type', ('cadence',), 'custom_target_cadence_high', 1),
+            ('target_type', ('heart_rate',), 'custom_target_heart_rate_high', 1),
+            ('target_type', ('power',), 'custom_target_power_high', 1),
+            ('target_type', ('speed',), 'custom_target_speed_high', 1000),
+        ],
+    },
+}
+
+# message name -> {field name: (component field name, scale)}, only added when the message lacks the component
+COMPONENTS = {
+    'lap': {
+        'avg_speed': ('enhanced_avg_speed', 1000),
+    },
+    'record': {
+        'speed': ('enhanced_speed', 1000),
+    },
+}
+
+WORKOUT_MESSAGE_NAMES = ('file_id', 'lap', 'workout_step', 'user_profile')
+
+# base type number -> (struct format, size, invalid value)
+_BASE_TYPES = {
+    0: ('B', 1, 0xFF),  # enum
+    1: ('b', 1, 0x7F),  # sint8
+    2: ('B', 1, 0xFF),  # uint8
+    3: ('h', 2, 0x7FFF),  # sint16
+    4: ('H', 2, 0xFFFF),  # uint16
+    5: ('i', 4, 0x7FFFFFFF),  # sint32
+    6: ('I', 4, 0xFFFFFFFF),  # uint32
+    10: ('B', 1, 0x00),  # uint8z
+    11: ('H', 2, 0x0000),  # uint16z
+    12: ('I', 4, 0x00000000),  # uint32z
+    13: ('B', 1, 0xFF),  # byte
+    14: ('q', 8, 0x7FFFFFFFFFFFFFFF),  # sint64
+    15: ('Q', 8, 0xFFFFFFFFFFFFFFFF),  # uint64
+    16: ('Q', 8, 0x0000000000000000),  # uint64z
+}
+
+_FILE_HEADER = struct.Struct('<BBHI4s')
+_FIELD_DEFINITION_SIZE = 3
+_CRC_SIZE = 2
+# The largest possible record is a header byte plus 255 fields and 255 developer fields of 255 bytes each
+_LOOKAHEAD_SIZE = 1 << 17
+_REFILL_SIZE = 2 * _LOOKAHEAD_SIZE
+
+
+class _Definition:
+    __slots__ = ('name', 'size', 'layout', 'accessors')
+
+    def __init__(self, name, size, layout=None, accessors=None):
+        self.name = name
+        self.size = size
+        self.layout = layout
+        self.accessors = accessors
+
+
+class FitMessage:
+    __slots__ = ('name', 'accessors', 'raw_values')
+
+    def __init__(self, name, accessors, raw_values):
+        self.name = name
+        self.accessors = accessors
+        self.raw_values = raw_values
+
+    def __getitem__(self, field_name):
+        accessor = self.accessors.get(field_name)
+        value = _MISSING if accessor is None else accessor[1](self.raw_values)
+        if value is _MISSING:
+            raise MissingFieldError(f"Field \"{field_name}\" not found in {self.name} message")
+        return value
+
+    def __contains__(self, field_name):
+        return self.get(field_name, _MISSING) is not _MISSING
+
+    def get(self, field_name, default=None):
+        accessor = self.accessors.get(field_name)
+        value = _MISSING if accessor is None else accessor[1](self.raw_values)
+        return default if value is _MISSING else value
+
+    @property
+    def fields(self):
+        fields = []
+        for field_name, (index, accessor, *_) in self.accessors.items():
+            value = accessor(self.raw_values)
+            if value is not _MISSING:
+                fields.append(FitField(field_name, value, self.raw_values[index]))
+        return fields
+
+    def field_column(self, field_name):
+        # (index in raw_values, invalid raw value, scale) for decoding a field of many messages at once,
+        # None for subfields as their value depends on another field
+        accessor = self.accessors.get(field_name)
+        if accessor is None or accessor[2] is None:
+            return None
+        return accessor[0], accessor[2], accessor[3]
+
+
+def _read_definition(buf, offset, has_developer_data, message_profiles, layouts):
+    architecture = buf[offset + 1]
+    endian = '>' if architecture == 1 else '<'
+    global_message_number, = struct.unpack_from(endian + 'H', buf, offset + 2)
+    num_fields = buf[offset + 4]
+    offset += 5
+
+    field_definitions = bytes(buf[offset:offset + num_fields * _FIELD_DEFINITION_SIZE])
+    offset += num_fields * _FIELD_DEFINITION_SIZE
+    size = sum(field_definitions[1::_FIELD_DEFINITION_SIZE])
+
+    if has_developer_data:
+        num_developer_fields = buf[offset]
+        offset += 1
+        developer_field_definitions = buf[offset:offset + num_developer_fields * _FIELD_DEFINITION_SIZE]
+        offset += num_developer_fields * _FIELD_DEFINITION_SIZE
+        size += sum(developer_field_definitions[1::_FIELD_DEFINITION_SIZE])
+
+    message_profile = message_profiles.get(global_message_number)
+    if message_profile is None:
+        return _Definition(None, size), offset
+
+    message_name = message_profile[0]
+    key = (endian, global_message_number, field_definitions)
+    compiled = layouts.get(key)
+    if compiled is None:
+        compiled = _compile_layout(endian, field_definitions, message_profile)
+        layouts[key] = compiled
+
+    layout, accessors = compiled
+    return _Definition(message_name, size, layout, accessors), offset
+
+
+def _compile_layout(endian, field_definitions, message_profile):
+    message_name, field_profiles = message_profile
+    layout = endian
+    fields = {}
+    for i in range(0, len(field_definitions), _FIELD_DEFINITION_SIZE):
+        field_number, field_size, base_type = field_definitions[i:i + _FIELD_DEFINITION_SIZE]
+        field_profile = field_profiles.get(field_number)
+        base_type_format = _BASE_TYPES.get(base_type & 0x1F)
+
+        # Arrays, strings and unwanted fields are skipped as pad bytes
+        if field_profile is None or base_type_format is None or base_type_format[1] != field_size:
+            layout += f'{field_size}x'
+        else:
+            layout += base_type_format[0]
+            field_name, scale, enum_values = field_profile
+            fields[field_name] = (len(fields), base_type_format[2], scale, enum_values)
+
+    # The accessors are shared by every data message using this definition,
+    # so resolving a field by name is a single dict lookup. Each is (index, accessor, invalid, scale)
+    accessors = {}
+    for field_name, (index, invalid, scale, enum_values) in fields.items():
+        accessors[field_name] = (index, _field_accessor(index, invalid, scale, enum_values), invalid, scale)
+
+    for field_name, subfields in SUBFIELDS.get(message_name, {}).items():
+        if field_name not in fields:
+            continue
+        index, invalid = fields[field_name][:2]
+        # Subfields are resolved in profile order, so an earlier matching subfield hides the later ones
+        earlier_references = []
+        for reference_name, reference_values, subfield_name, scale in subfields:
+            if reference_name not in fields:
+                continue
+            reference_accessor = accessors[reference_name][1]
+            if subfield_name not in accessors:
+                accessors[subfield_name] = (index, _subfield_accessor(
+                    _field_accessor(index, invalid, scale, None), reference_accessor, reference_values,
+                    tuple(earlier_references)), None, None)
+            earlier_references.append((reference_accessor, reference_values))
+
+    for field_name, (component_name, scale) in COMPONENTS.get(message_name, {}).items():
+        if field_name in fields and component_name not in accessors:
+            index, invalid = fields[field_name][:2]
+            accessors[component_name] = (index, _field_accessor(index, invalid, scale, None), invalid, scale)
+
+    return struct.Struct(layout), accessors
+
+
+def _field_accessor(index, invalid, scale, enum_values):
+    if enum_values is not None:
+        def accessor(raw_values):
+            raw_value = raw_values[index]
+            return None if raw_value == invalid else enum_values.get(raw_value, raw_value)
+    elif scale != 1:
+        def accessor(raw_values):
+            raw_value = raw_values[index]
+            return None if raw_value == invalid else raw_value / scale
+    else:
+        def accessor(raw_values):
+            raw_value = raw_values[index]
+            return None if raw_value == invalid else raw_value
+
+    return accessor
+
+
+def _subfield_accessor(field_accessor, reference_accessor, reference_values, earlier_references):
+    def accessor(raw_values):
+        for earlier_reference_accessor, earlier_reference_values in earlier_references:
+            if earlier_reference_accessor(raw_values) in earlier_reference_values:
+                return _MISSING
+        if reference_accessor(raw_values) in reference_values:
+            return field_accessor(raw_values)
+        return _MISSING
+
+    return accessor
+
+
+def _decode_message(definition, buf, offset):
+    return FitMessage(definition.name, definition.accessors, definition.layout.unpack_from(buf, offset))
+
+
+def _refill(buf, offset, size, chunks):
+    # Returns the unread part of buf topped up to at least size bytes, and whether the chunks ran out
+    parts = [buf[offset:]] if offset < len(buf) else []
+    available = len(buf) - offset
+    exhausted = False
+    while available < size:
+        chunk = next(chunks, None)
+        if chunk is None:
+            exhausted = True
+            break
+        parts.append(chunk)
+        available += len(chunk)
+
+    # A single part is used as is, so a mapped file is never copied
+    if len(parts) == 1:
+        return parts[0], exhausted
+    return b''.join(parts), exhausted
+
+
+def _iter_chunk_messages(chunks, message_profiles, stats=None):
+    chunks = iter(chunks)
+    layouts = {}
+    buf, exhausted = _refill(b'', 0, _REFILL_SIZE, chunks)
+    # The stream position of buf[0]
+    base = 0
+    offset = 0
+    # Counted in locals as this is the hot loop, stats is only updated once the messages stop
+    decoded = 0
+    skipped = 0
+
+    try:
+        # A FIT file may be a chain of several FIT files, each with its own header and CRC
+        while True:
+            if not exhausted and len(buf) - offset < _LOOKAHEAD_SIZE:
+                base += offset
+                buf, exhausted = _refill(buf, offset, _REFILL_SIZE, chunks)
+                offset = 0
+
+            if offset >= len(buf):
+                return
+
+            header_size, _, _, data_size, data_type = _FILE_HEADER.unpack_from(buf, offset)
+            if data_type != b'.FIT':
+                raise FitDecodeError(f"Invalid FIT file header at offset {base + offset}")
+
+            offset += header_size
+            data_end = base + offset + data_size
+
+            definitions = {}
+            while base + offset < data_end:
+                # Keep at least one whole record buffered, so records never need to be reassembled
+                if not exhausted and len(buf) - offset < _LOOKAHEAD_SIZE:
+                    base += offset
+                    buf, exhausted = _refill(buf, offset, _REFILL_SIZE, chunks)
+                    offset = 0
+
+                header = buf[offset]
+                offset += 1
+
+                if header & 0x80:
+                    local_message_type = (header >> 5) & 0x03
+                elif header & 0x40:
+                    definitions[header & 0x0F], offset = _read_definition(buf, offset, header & 0x20,
+                                                                          message_profiles, layouts)
+                    continue
+                else:
+                    local_message_type = header & 0x0F
+
+                definition = definitions.get(local_message_type)
+                if definition is None:
+                    raise FitDecodeError(f"Local message type {local_message_type} not defined "
+                                         f"at offset {base + offset - 1}")
+
+                if definition.layout is not None:
+                    decoded += 1
+                    yield _decode_message(definition, buf, offset)
+                else:
+                    skipped += 1
+
+                offset += definition.size
+
+            if offset > len(buf):
+                raise FitDecodeError(f"Truncated FIT file, expected {offset - len(buf)} more bytes")
+            if base + offset != data_end:
+                raise FitDecodeError(f"Record crosses the end of the FIT data at offset {data_end}")
+
+            offset += _CRC_SIZE
+    except (struct.error, IndexError) as e:
+        raise FitDecodeError(f"Truncated FIT file at offset {base + offset}") from e
+    finally:
+        if stats is not None:
+            stats['frames_decoded'] += decoded
+            stats['frames_skipped'] += skipped
+
+
+def _read_buffer(file):
+    if isinstance(file, (bytes, bytearray, memoryview)):
+        return file
+
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, 'rb') as f:
+            return _read_buffer(f)
+
+    try:
+        file.seek(0, 0)
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, OSError, ValueError):
+        # In-memory files have no file descriptor and empty files can not be mapped
+        file.seek(0, 0)
+        return file.read()
+
+
+def _message_profiles(message_names):
+    return {number: profile for number, profile in MESSAGE_PROFILES.items() if profile[0] in message_names}
+
+
+def iter_messages(file, message_names=WORKOUT_MESSAGE_NAMES, stats=None):
+    buf = _read_buffer(file)
+    try:
+        yield from _iter_chunk_messages([buf], _message_profiles(message_names), stats)
+    finally:
+        if isinstance(buf, mmap.mmap):
+            buf.close()
+
+
+def iter_stream_messages(chunks, message_names=WORKOUT_MESSAGE_NAMES, stats=None):
+    # Decodes as the chunks arrive, only about _REFILL_SIZE bytes are held at any time.
+    # stats, a collections.Counter say, gets the number of frames decoded and skipped
+    return _iter_chunk_messages(chunks, _message_profiles(message_names), stats)
@@ -0,0 +1,185 @@
+import random
+import struct
+
+_CRC_TABLE = (0x0000, 0xCC01, 0xD801, 0x1400, 0xF001, 0x3C00, 0x2800, 0xE401,
+              0xA001, 0x6C00, 0x7800, 0xB401, 0x5000, 0x9C01, 0x8801, 0x4400)
+
+# base type -> struct format
+_BASE_TYPE_FORMATS = {0x00: 'B', 0x02: 'B', 0x84: 'H', 0x86: 'I'}
+
+ENUM = 0x00
+UINT8 = 0x02
+UINT16 = 0x84
+UINT32 = 0x86
+
+INVALID_ENUM = 0xFF
+INVALID_UINT32 = 0xFFFFFFFF
+
+# message name -> (global message number, [(field number, base type)])
+MESSAGE_DEFINITIONS = {
+    'file_id': (0, [(0, ENUM), (1, UINT16), (4, UINT32)]),
+    'user_profile': (3, [(4, UINT16)]),
+    'workout_step': (27, [(254, UINT16), (1, ENUM), (2, UINT32), (3, ENUM), (4, UINT32), (5, UINT32),
+                          (6, UINT32), (7, ENUM)]),
+    'record': (20, [(253, UINT32), (5, UINT32), (73, UINT32), (3, UINT8)]),
+    'lap': (19, [(254, UINT16), (253, UINT32), (2, UINT32), (7, UINT32), (8, UINT32), (9, UINT32),
+                 (13, UINT16), (110, UINT32), (15, UINT8), (21, UINT16), (22, UINT16), (71, UINT16)]),
+}
+
+# A fixed start so generated files are byte-for-byte reproducible, seconds since the FIT epoch
+START_TIMESTAMP = 1000000000
+
+
+def crc16(data, crc=0):
+    for byte in data:
+        tmp = _CRC_TABLE[crc & 0xF]
+        crc = (crc >> 4) & 0x0FFF
+        crc = crc ^ tmp ^ _CRC_TABLE[byte & 0xF]
+        tmp = _CRC_TABLE[crc & 0xF]
+        crc = (crc >> 4) & 0x0FFF
+        crc = crc ^ tmp ^ _CRC_TABLE[(byte >> 4) & 0xF]
+    return crc
+
+
+class FitWriter:
+    def __init__(self, big_endian=False):
+        self.endian = '>' if big_endian else '<'
+        self.data = bytearray()
+        self.layouts = {}
+
+    def define(self, local_message_type, message_name):
+        global_message_number, fields = MESSAGE_DEFINITIONS[message_name]
+        self.data += struct.pack(self.endian + 'BBBHB', 0x40 | local_message_type, 0,
+                                 1 if self.endian == '>' else 0, global_message_number, len(fields))
+        for field_number, base_type in fields:
+            self.data += struct.pack('BBB', field_number, struct.calcsize(_BASE_TYPE_FORMATS[base_type]), base_type)
+        self.layouts[local_message_type] = struct.Struct(
+            self.endian + str.join('', map(lambda x: _BASE_TYPE_FORMATS[x[1]], fields)))
+
+    def write(self, local_message_type, *values):
+        self.data.append(local_message_type)
+        self.data += self.layouts[local_message_type].pack(*values)
+
+    def getvalue(self):
+        header = struct.pack('<BBHI4s', 14, 0x20, 2132, len(self.data), b'.FIT')
+        header += struct.pack('<H', crc16(header))
+        content = header + self.data
+        return bytes(content + struct.pack('<H', crc16(content)))
+
+
+# step kind -> (intensity, duration type, target type, speed in m/s)
+_STEP_KINDS = {
+    'warmup': (2, 5, 2, 3.0),
+    'active': (0, 1, 0, 4.0),
+    'recovery': (4, 0, 2, 2.5),
+    'cooldown': (3, 5, 2, 3.0),
+}
+
+
+def _build_workout(repeat_blocks, repeat_times, nested_repeats):
+    workout = [('warmup',)]
+    for _ in range(repeat_blocks):
+        node = ('repeat', repeat_times, [('active',), ('recovery',)])
+        for _ in range(nested_repeats):
+            node = ('repeat', 2, [node])
+        workout.append(node)
+    workout.append(('cooldown',))
+    return workout
+
+
+def _add_workout_steps(nodes, step_distance, recovery_time, workout_steps):
+    # Children are numbered before their repeat step, which points back at the first child
+    plan = []
+    for node in nodes:
+        if node[0] == 'repeat':
+            first_index = len(workout_steps)
+            children = _add_workout_steps(node[2], step_distance, recovery_time, workout_steps)
+            workout_steps.append((len(workout_steps), 6, first_index, INVALID_ENUM, node[1],
+                                  INVALID_UINT32, INVALID_UINT32, INVALID_ENUM))
+            plan.append(('repeat', node[1], children))
+        else:
+            intensity, duration_type, target_type, speed = _STEP_KINDS[node[0]]
+            if duration_type == 1:
+                duration_value = int(step_distance * 100)
+            elif duration_type == 0:
+                duration_value = int(recovery_time * 1000)
+            else:
+                duration_value = INVALID_UINT32
+
+            if target_type == 0:
+                target_low, target_high = int((speed - 0.1) * 1000), int((speed + 0.1) * 1000)
+            else:
+                target_low, target_high = INVALID_UINT32, INVALID_UINT32
+
+            plan.append(('step', node[0], len(workout_steps)))
+            workout_steps.append((len(workout_steps), duration_type, duration_value, target_type, 0,
+                                  target_low, target_high, intensity))
+    return plan
+
+
+def _executed_steps(plan):
+    for node in plan:
+        if node[0] == 'repeat':
+            for _ in range(node[1]):
+                yield from _executed_steps(node[2])
+        else:
+            yield node[1], node[2]
+
+
+# Repeat blocks of active and recovery steps between a warmup and a cooldown, each block optionally nested in
+# further repeats. Every executed step is split into laps_per_step laps with a record every record_interval seconds.
+def generate_workout_fit(repeat_blocks=2, repeat_times=4, nested_repeats=0, laps_per_step=1,
+                         step_distance=1000, recovery_time=120, warmup_time=600, record_interval=1,
+                         weight=70.0, big_endian=False, seed=0):
+    rng = random.Random(seed)
+    writer = FitWriter(big_endian)
+
+    writer.define(0, 'file_id')
+    writer.write(0, 4, 1, START_TIMESTAMP)
+    writer.define(1, 'user_profile')
+    writer.write(1, int(weight * 10))
+
+    workout_steps = []
+    plan = _add_workout_steps(_build_workout(repeat_blocks, repeat_times, nested_repeats),
+                              step_distance, recovery_time, workout_steps)
+    writer.define(2, 'workout_step')
+    for workout_step in workout_steps:
+        writer.write(2, *workout_step)
+
+    writer.define(3, 'record')
+    writer.define(4, 'lap')
+
+    timestamp = START_TIMESTAMP
+    distance = 0.0
+    lap_index = 0
+    for step_kind, step_index in _executed_steps(plan):
+        speed = _STEP_KINDS[step_kind][3]
+        if step_kind == 'active':
+            step_time = step_distance / speed
+        elif step_kind == 'recovery':
+            step_time = recovery_time
+        else:
+            step_time = warmup_time
+
+        lap_time = max(int(step_time / laps_per_step), record_interval)
+        for _ in range(laps_per_step):
+            lap_start_timestamp = timestamp
+            lap_start_distance = distance
+            heart_rate_total = 0
+            for _ in range(0, lap_time, record_interval):
+                record_speed = speed + rng.uniform(-0.2, 0.2)
+                heart_rate = int(120 + 12 * speed + rng.uniform(-5, 5))
+                timestamp += record_interval
+                distance += record_speed * record_interval
+                heart_rate_total += heart_rate * record_interval
+                writer.write(3, timestamp, int(distance * 100), int(record_speed * 1000), heart_rate)
+
+            lap_elapsed_time = timestamp - lap_start_timestamp
+            lap_distance = distance - lap_start_distance
+            lap_speed = int(lap_distance / lap_elapsed_time * 1000)
+            writer.write(4, lap_index, timestamp, lap_start_timestamp, lap_elapsed_time * 1000,
+                         lap_elapsed_time * 1000, int(lap_distance * 100), min(lap_speed, 0xFFFE), lap_speed,
+                         int(heart_rate_total / lap_elapsed_time), rng.randint(0, 10), rng.randint(0, 10), step_index)
+            lap_index += 1
+
+    return writer.getvalue()
@@ -1,19 +1,14 @@
 import argparse
-import configparser
-import datetime
 import logging
 import os
-import re
-import sys
-import tempfile
 
-import fitdecode
-
-from stravalib import Client
-from stravaweblib import WebClient
-
-from descriptions import get_workout_title, get_workout_description
-from workout_types import Workout, WorkStep, WorkStepRepeat, Lap, RepeatStep
+from archive import CODECS, DEFAULT_CODEC, archive_main
+from batch import OUTPUT_FORMATS, batch_main
+from renderer import DETAILS, render_workout
+from spool import DEFAULT_SPOOL_SIZE
+from workout_cache import DEFAULT_CACHE_SIZE
+from workout_parser import DECODERS, create_workout
+from workout_types import Workout, WorkStep, RepeatStep
 
 __log__ = logging.getLogger(__name__)
 
@@ -22,148 +17,29 @@ CONFIG_FILE = os.path.join(
     'strava-workout.conf'
 )
 
+STATE_FILE = os.path.join(
+    os.environ.get('XDG_STATE_HOME', os.path.join(os.path.expanduser('~'), '.local', 'state')),
+    'strava-workout.sqlite'
+)
+
+CREDENTIALS_FILE = os.path.join(
+    os.environ.get('XDG_STATE_HOME', os.path.join(os.path.expanduser('~'), '.local', 'state')),
+    'strava-workout-credentials.json'
+)
+
+CACHE_FILE = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')),
+    'strava-workout.sqlite'
+)
+
+ARCHIVE_DIR = os.path.join(
+    os.environ.get('XDG_DATA_HOME', os.path.join(os.path.expanduser('~'), '.local', 'share')),
+    'strava-workout-archive'
+)
 
-def print_fields(fields):
-    for field in fields:
-        print(f"{field.name} = {field.value} ({field.raw_value})")
-    print()
-
-
-def get_frame_field_by_name(frame, field_name):
-    for field in frame.fields:
-        if field.name == field_name:
-            return field
-
-    raise ValueError(f"Field \"{field_name}\" not found in frame")
-
-
-def get_workout_step_indexes(workout_steps):
-    for workout_step in workout_steps:
-        if isinstance(workout_step, WorkStep):
-            yield workout_step.index
-        elif isinstance(workout_step, RepeatStep):
-            for workout_step_index in get_workout_step_indexes(workout_step.steps):
-                yield workout_step_index
-
-
-def get_workout_step_by_index(workout_steps, index):
-    for workout_step in workout_steps:
-        if isinstance(workout_step, WorkStep):
-            if workout_step.index == index:
-                return workout_step
-        elif isinstance(workout_step, RepeatStep):
-            workout_step = get_workout_step_by_index(workout_step.steps, index)
-            if workout_step is not None:
-                return workout_step
-        else:
-            raise ValueError()
-
-    return None
-
-
-# TODO: check workout exists or return None, check it is running
-def create_workout(file):
-    user_profile = None
-    lap_frames = []
-    workout_step_frames = []
-
-    with fitdecode.FitReader(file) as fit:
-        for frame in fit:
-            if frame.frame_type == fitdecode.FIT_FRAME_DATA:
-                if frame.name == 'lap':
-                    lap_frames.append(frame)
-                elif frame.name == 'workout_step':
-                    workout_step_frames.append(frame)
-                elif frame.name == 'user_profile':
-                    assert user_profile is None
-                    user_profile = frame
-
-    if len(workout_step_frames) == 0:
-        return None
-
-    workout_steps = []
-
-    for frame in workout_step_frames:
-        workout_step_type = get_frame_field_by_name(frame, 'intensity').value
-        workout_step_duration_type = get_frame_field_by_name(frame, 'duration_type').value
-
-        # TODO: Hack for Garmin recommended workout
-        if workout_step_type is 'active' and workout_step_duration_type == 'repeat_until_steps_cmplt':
-            workout_step_type = None
-
-        # TODO: need to see how this works in other files
-        if workout_step_type is None and workout_step_duration_type == 'repeat_until_steps_cmplt':
-            num_steps_to_repeat = get_frame_field_by_name(frame, 'message_index').value - \
-                                  get_frame_field_by_name(frame, 'duration_step').value
-            assert num_steps_to_repeat > 0
-
-            workout_step = RepeatStep(get_frame_field_by_name(frame, 'message_index').value,
-                                      workout_step_type,
-                                      get_frame_field_by_name(frame, 'repeat_steps').value,
-                                      workout_steps[-num_steps_to_repeat:])
-
-            workout_steps = workout_steps[:len(workout_steps) - num_steps_to_repeat]
-
-        else:
-            workout_step = WorkStep(get_frame_field_by_name(frame, 'message_index').value,
-                                    workout_step_type,
-                                    workout_step_duration_type,
-                                    None,
-                                    get_frame_field_by_name(frame, 'target_type').value)
-
-            if workout_step.duration_type == 'time':
-                workout_step.duration = datetime.timedelta(
-                    seconds=get_frame_field_by_name(frame, 'duration_time').value)
-            elif workout_step.duration_type == 'distance':
-                workout_step.duration = get_frame_field_by_name(frame, 'duration_distance').value
-            elif workout_step.duration_type == 'hr_less_than':
-                workout_step.duration = get_frame_field_by_name(frame, 'duration_hr').value - 100  # TODO: 210 vs 110
-            elif workout_step.duration_type == 'open':
-                pass
-            elif workout_step.duration_type is None:
-                pass
-            else:
-                raise ValueError(f"Unknown duration_type \"{workout_step.duration_type}\"")
-
-            if workout_step.target_type == 'speed':
-                workout_step.target_low = get_frame_field_by_name(frame, 'custom_target_speed_low').value
-                workout_step.target_high = get_frame_field_by_name(frame, 'custom_target_speed_high').value
-            elif workout_step.target_type == 'heart_rate':
-                workout_step.target_zone = get_frame_field_by_name(frame, 'target_hr_zone').value
-                workout_step.target_low = get_frame_field_by_name(frame, 'custom_target_heart_rate_low').value
-                workout_step.target_high = get_frame_field_by_name(frame, 'custom_target_heart_rate_high').value
-            elif workout_step.target_type == 'open':
-                pass
-            elif workout_step.target_type is None:
-                pass
-            else:
-                raise ValueError(f"Unknown target_type \"{workout_step.target_type}\"")
-
-        workout_steps.append(workout_step)
-
-    # TODO: what to do if end of workout?
-    last_workout_step_index = None
-    for frame in lap_frames:
-        workout_step = get_workout_step_by_index(workout_steps, get_frame_field_by_name(frame, 'wkt_step_index').value)
-
-        # TODO: end of workout?
-        if workout_step is None:
-            break
-
-        if workout_step.index != last_workout_step_index:
-            last_workout_step_index = workout_step.index
-            workout_step.repeats.append(WorkStepRepeat([]))
-
-        workout_step.repeats[-1].laps.append(Lap(
-            get_frame_field_by_name(frame, 'total_distance').value,
-            datetime.timedelta(seconds=get_frame_field_by_name(frame, 'total_elapsed_time').value),
-            get_frame_field_by_name(frame, 'enhanced_avg_speed').value,
-            get_frame_field_by_name(frame, 'avg_heart_rate').value,
-            get_frame_field_by_name(frame, 'total_ascent').value,
-            get_frame_field_by_name(frame, 'total_descent').value,
-        ))
-
-    return Workout(get_frame_field_by_name(user_profile, 'weight').value, workout_steps)
+DEFAULT_BACKFILL_BATCH_SIZE = 50
+DEFAULT_LOOKBACK_DAYS = 7
+DEFAULT_RATE_LIMIT_WAIT = 15 * 60
 
 
 def print_workout_description():
@@ -179,6 +55,105 @@ def print_workout_description():
     print(workout)
 
 
+def describe_workouts(paths, decoder='fast', analysis=False):
+    for path in paths:
+        workout = create_workout(path, decoder)
+        if workout is None:
+            __log__.warning("No workout found in %s", path)
+            continue
+
+        if analysis:
+            from analysis import analyse_workout
+            analyse_workout(path, workout)
+
+        rendering = render_workout(workout)
+        print(rendering.title)
+        print(rendering.description)
+        print()
+
+
+def get_default_function(defaults):
+    # The commands take the same options as the sync, so they can be given after the command as well as before it.
+    # A command's copies have no defaults, so they never overwrite an option given before the command.
+    if defaults:
+        return lambda x: x
+    return lambda x: argparse.SUPPRESS
+
+
+def add_parse_arguments(parser, defaults=True):
+    default = get_default_function(defaults)
+    parser.add_argument("--decoder", choices=DECODERS, default=default('fast'),
+                        help="The FIT decoder to use, fitdecode is slower but handles the full FIT protocol "
+                             "(default: fast)")
+    parser.add_argument("--analysis", action='store_true', default=default(False),
+                        help="Analyse the records of each repeat and add the fastest split, pace variability, "
+                             "heart rate drift and time to target pace to the description, needs numpy")
+
+
+def add_sync_arguments(parser, defaults=True):
+    default = get_default_function(defaults)
+    # The config file is opened on demand, so offline commands work without one
+    parser.add_argument("--config", nargs="?", type=argparse.FileType('rt'), default=default(None),
+                        help=f"The config file to use (default: {CONFIG_FILE})")
+    parser.add_argument("--download-workers", type=int, default=default(1),
+                        help="The number of activities to download at once (default: 1)")
+    parser.add_argument("--parse-workers", type=int, default=default(1),
+                        help="The number of activities to parse at once (default: 1)")
+    parser.add_argument("--upload-workers", type=int, default=default(1),
+                        help="The number of activity updates to upload at once (default: 1)")
+    parser.add_argument("--spool-size", type=int, default=default(DEFAULT_SPOOL_SIZE),
+                        help="The size in bytes above which a downloaded FIT file is spilled to a temporary file "
+                             f"(default: {DEFAULT_SPOOL_SIZE})")
+    parser.add_argument("--state", default=default(STATE_FILE),
+                        help=f"The database of synced activities (default: {STATE_FILE})")
+    parser.add_argument("--reprocess", action='store_true', default=default(False),
+                        help="Process activities that have already been synced, their files are downloaded again "
+                             "if they changed on Strava since, and they are only updated if changed")
+    parser.add_argument("--lookback-days", type=float, default=default(DEFAULT_LOOKBACK_DAYS),
+                        help="How far before the latest synced activity a sync looks for activities uploaded late "
+                             f"(default: {DEFAULT_LOOKBACK_DAYS})")
+    parser.add_argument("--backfill", action='store_true', default=default(False),
+                        help="Work back through the whole activity history, resuming where the last backfill stopped")
+    parser.add_argument("--backfill-batch-size", type=int, default=default(DEFAULT_BACKFILL_BATCH_SIZE),
+                        help="The number of activities to fetch per backfill batch "
+                             f"(default: {DEFAULT_BACKFILL_BATCH_SIZE})")
+    parser.add_argument("--rerender", action='store_true', default=default(False),
+                        help="Regenerate the title and description of every synced activity, "
+                             "using cached workouts instead of downloading where possible")
+    parser.add_argument("--credentials", default=default(CREDENTIALS_FILE),
+                        help="The file the access token and Strava website session are kept in between runs, "
+                             f"only readable by its owner (default: {CREDENTIALS_FILE})")
+    parser.add_argument("--compare-sessions", type=int, default=default(0), metavar="N",
+                        help="Add the pace of each step compared with the last N activities of the same workout "
+                             "to the description (default: 0)")
+    parser.add_argument("--force-update", action='store_true', default=default(False),
+                        help="Write the name and description of every processed activity, even when they are "
+                             "already up to date")
+    parser.add_argument("--cache", default=default(CACHE_FILE),
+                        help=f"The cache of parsed workouts (default: {CACHE_FILE})")
+    parser.add_argument("--cache-size", type=int, default=default(DEFAULT_CACHE_SIZE),
+                        help=f"The size in bytes the workout cache is trimmed to (default: {DEFAULT_CACHE_SIZE})")
+    parser.add_argument("--archive", default=default(ARCHIVE_DIR),
+                        help="The directory downloaded and watched FIT files are kept in, compressed, so activities "
+                             f"are parsed again from it instead of downloaded (default: {ARCHIVE_DIR})")
+    parser.add_argument("--archive-codec", choices=CODECS, default=default(DEFAULT_CODEC),
+                        help="The compression of newly archived FIT files, lzma is smaller but slower "
+                             f"(default: {DEFAULT_CODEC})")
+    parser.add_argument("--no-archive", action='store_true', default=default(False),
+                        help="Neither read FIT files from the archive nor add them to it")
+    parser.add_argument("--rate-limit-wait", type=float, default=default(DEFAULT_RATE_LIMIT_WAIT),
+                        help="The most seconds to wait for the Strava rate limits to reset before failing, "
+                             "a backfill stops here when it reaches its share of the daily limit "
+                             f"(default: {DEFAULT_RATE_LIMIT_WAIT})")
+    parser.add_argument("--metrics-json", default=default(None),
+                        help="Write the stage timings and counters of the run to this JSON file")
+    parser.add_argument("--metrics-prometheus", default=default(None),
+                        help="Write the stage timings and counters of the run to this Prometheus textfile "
+                             "collector file")
+    parser.add_argument("--profile-decode", default=default(None),
+                        help="Write a cProfile dump of FIT decoding to this file, decoding runs one at a time")
+
+
 def main():
     # workout = create_workout('C:\\Users\\dylan\\Downloads\\Afternoon_Run 2km.fit')
     # print(workout.description(False, False, False, False, False))
@@ -187,72 +162,112 @@ def main():
     parser = argparse.ArgumentParser(
         description='Create workout descriptions from your FIT files.'
     )
-    parser.add_argument("--config", nargs="?", type=argparse.FileType('rt'),
-                        default=CONFIG_FILE,
-                        help="The config file to use (default: %(default)s)")
+    add_parse_arguments(parser)
+    add_sync_arguments(parser)
+
+    subparsers = parser.add_subparsers(dest='command', title='commands',
+                                       description="Without a command the latest activities are synced with Strava")
+    describe_parser = subparsers.add_parser('describe', help="Print the title and description of local FIT files")
+    add_parse_arguments(describe_parser, defaults=False)
+    describe_parser.add_argument("paths", nargs='+', help="The FIT files to describe")
+    watch_parser = subparsers.add_parser('watch', help="Watch a directory and sync new FIT files as they appear")
+    add_parse_arguments(watch_parser, defaults=False)
+    add_sync_arguments(watch_parser, defaults=False)
+    watch_parser.add_argument("directory", help="The directory to watch, such as a Garmin sync folder")
+    watch_parser.add_argument("--poll-interval", type=float, default=2,
+                              help="The seconds between scans of the directory (default: %(default)s)")
+    watch_parser.add_argument("--settle-time", type=float, default=5,
+                              help="The seconds a file must stay unchanged before it is read (default: %(default)s)")
+    watch_parser.add_argument("--match-interval", type=float, default=30,
+                              help="The least seconds between fetches of recent activities while a file has no "
+                                   "Strava activity yet (default: %(default)s)")
+    watch_parser.add_argument("--match-tolerance", type=float, default=120,
+                              help="The most seconds a Strava activity may start from the FIT file "
+                                   "(default: %(default)s)")
+    watch_parser.add_argument("--match-timeout", type=float, default=60 * 60,
+                              help="The seconds to wait for the Strava activity of a file before giving up "
+                                   "(default: %(default)s)")
+    webhook_parser = subparsers.add_parser('webhook', help="Receive Strava webhook events and sync activities as "
+                                                           "they are created or updated")
+    add_parse_arguments(webhook_parser, defaults=False)
+    add_sync_arguments(webhook_parser, defaults=False)
+    webhook_parser.add_argument("--host", default='localhost',
+                                help="The address to listen on, put it behind a public HTTPS proxy for Strava "
+                                     "(default: %(default)s)")
+    webhook_parser.add_argument("--port", type=int, default=8080,
+                                help="The port to listen on (default: %(default)s)")
+    webhook_parser.add_argument("--verify-token",
+                                help="The token Strava sends back in the subscription handshake "
+                                     "(default: verify_token in the [webhook] section of the config)")
+    webhook_parser.add_argument("--subscribe", metavar="CALLBACK_URL",
+                                help="Create the push subscription for this public URL of the receiver once it is "
+                                     "listening")
+    webhook_parser.add_argument("--batch-delay", type=float, default=2,
+                                help="The seconds to gather further events before processing (default: %(default)s)")
+    webhook_event_parser = subparsers.add_parser('webhook-event',
+                                                 help="Post a fake activity event to a running webhook receiver")
+    webhook_event_parser.add_argument("url", help="The URL of the receiver, such as http://localhost:8080/")
+    webhook_event_parser.add_argument("activity_id", type=int, help="The activity of the event")
+    webhook_event_parser.add_argument("--owner-id", type=int, required=True,
+                                      help="The athlete of the activity, as logged by the receiver")
+    webhook_event_parser.add_argument("--aspect-type", choices=('create', 'update'), default='create',
+                                      help="The kind of event (default: %(default)s)")
+    webhook_event_parser.add_argument("--title", help="The new title of an update event")
+    batch_parser = subparsers.add_parser('batch', help="Write workouts from local FIT files to CSV or JSON")
+    add_parse_arguments(batch_parser, defaults=False)
+    batch_parser.add_argument("paths", nargs='+',
+                              help="FIT files, globs or directories to search for FIT files")
+    batch_parser.add_argument("--output", "-o", default='-',
+                              help="The file to write (default: stdout)")
+    batch_parser.add_argument("--detail", choices=DETAILS, default='activity',
+                              help="Write a row per activity, also per repeat of each step, "
+                                   "or also per lap (default: %(default)s)")
+    batch_parser.add_argument("--format", choices=OUTPUT_FORMATS, default='csv',
+                              help="Write CSV rows, or a JSON object per workout and line with its steps and "
+                                   "repeats (default: %(default)s)")
+    batch_parser.add_argument("--workers", type=int, default=None,
+                              help="The number of processes to use (default: one per CPU)")
+    archive_parser = subparsers.add_parser('archive', help="Check, compact or summarise the FIT archive")
+    add_sync_arguments(archive_parser, defaults=False)
+    archive_parser.add_argument("action", choices=('verify', 'compact', 'stats'),
+                                help="Check every archived file decompresses to its content hash, rewrite the "
+                                     "archive without the files of activities that are no longer synced, or "
+                                     "print its size")
+    archive_parser.add_argument("--keep-unreferenced", action='store_true',
+                                help="Only reclaim the space of interrupted writes when compacting, keeping every "
+                                     "archived file")
     args = parser.parse_args()
 
-    config_data = args.config.read()
-    config = configparser.ConfigParser()
-    config.read_string(config_data)
-
-    client_id = int(config['api']['client_id'])
-    client_secret = config['api']['client_secret']
-    refresh_token = config['api']['refresh_token']
-    email = config['user']['email']
-    password = config['user']['password']
-
-    tokens = Client().refresh_access_token(client_id, client_secret, refresh_token)
-    if tokens['refresh_token'] != refresh_token:
-        refresh_token = tokens['refresh_token']
-        config_path = args.config.name
-        try:
-            if config_path == "<stdin>":
-                raise FileNotFoundError("Cannot write to config file passed via stdin")
-            with open(config_path, 'w') as f:
-                new_config = re.sub(
-                    r'^(\s*refresh_token\s*=\s*)\w+(.*)$',
-                    r'\1{}\2'.format(refresh_token),
-                    config_data
-                )
-                f.write(new_config)
-        except OSError:
-            __log__.warning(
-                "Failed to automatically update refresh token in the config file - "
-                "please update it manually", exc_info=True
-            )
-            __log__.warning("New refresh token is '%s'", refresh_token)
-
-    access_token = tokens['access_token']
-
-    client = WebClient(access_token=access_token, email=email, password=password)
-
-    activities = client.get_activities(limit=5)
-
-    for activity in activities:
-        if activity.type != 'Run':
-            continue
-
-        data = client.get_activity_data(activity.id)
-
-        if not data.filename.endswith('.fit'):
-            continue
-
-        __log__.info("Downloading activity %s (%s)", activity, data.filename)
-        with tempfile.TemporaryFile() as file:
-            file.writelines(data.content)
-            file.seek(0, 0)
-            activity_workout = create_workout(file)
-
-            if activity_workout is not None:
-                name = get_workout_title(activity_workout)
-                description = get_workout_description(activity_workout)
-                print(name)
-                print(description)
-                print()
-                client.update_activity(activity.id, name=name, description=description)
-
-    print(activities)
+    if args.command == 'describe':
+        describe_workouts(args.paths, args.decoder, args.analysis)
+        return
+    if args.command == 'batch':
+        batch_main(args)
+        return
+
+    if args.command == 'archive':
+        archive_main(args)
+        return
+
+    if args.command == 'webhook-event':
+        # Only needs urllib, not the Strava client stack of the receiver
+        from webhook_event import post_event_main
+        post_event_main(args)
+        return
+
+    if args.config is None:
+        args.config = open(CONFIG_FILE, 'rt')
+
+    # The sync imports the Strava client stack, so it is only loaded when it is needed
+    if args.command == 'watch':
+        from watch import watch_main
+        watch_main(args)
+    elif args.command == 'webhook':
+        from webhook import webhook_main
+        webhook_main(args)
+    else:
+        from sync import sync_main
+        sync_main(args)
 
 
 if __name__ == '__main__':
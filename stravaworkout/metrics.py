@@ -0,0 +1,146 @@
+import collections
+import contextlib
+import cProfile
+import json
+import os
+import pstats
+import threading
+import time
+
+PROMETHEUS_PREFIX = 'strava_workout'
+
+# counter -> Prometheus help text
+COUNTERS = {
+    'api_calls': "Strava API and website requests made",
+    'bytes_downloaded': "Bytes of activity files downloaded",
+    'frames_decoded': "FIT data messages decoded",
+    'frames_skipped': "FIT data messages skipped without decoding",
+    'laps_attributed': "Laps attributed to workout steps",
+    'activities_processed': "Activities processed",
+    'activities_cached': "Activities whose workout came from the cache",
+    'activities_archived': "Activities read from the local FIT archive instead of downloaded",
+    'activities_updated': "Activities whose name and description were updated",
+    'activities_unchanged': "Activities whose name and description were already up to date",
+    'activities_failed': "Activities that failed to download, parse or upload",
+    'files_watched': "FIT files read from the watched directory",
+    'webhook_events': "Activity events received from the Strava webhook",
+    'api_retries': "Strava requests retried after a rate limit or server error",
+}
+
+
+class Metrics:
+    # Stage timings and counters for one run, shared by the pipeline workers so every update goes through the lock.
+    # Stage seconds are summed over workers, so they can add up to more than the duration of the run.
+    def __init__(self, profile=False):
+        self.started_at = time.time()
+        self.finished_at = None
+        self.success = False
+        self.stage_seconds = collections.Counter()
+        self.stage_calls = collections.Counter()
+        self.counters = collections.Counter(dict.fromkeys(COUNTERS, 0))
+        self.lock = threading.Lock()
+        self.profile_stats = None
+        self.profile_lock = threading.Lock() if profile else None
+
+    @contextlib.contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            with self.lock:
+                self.stage_seconds[stage] += seconds
+                self.stage_calls[stage] += 1
+
+    @contextlib.contextmanager
+    def profile(self):
+        if self.profile_lock is None:
+            yield
+            return
+
+        # Only one profiler can be active at a time, so profiled code is run one thread at a time
+        with self.profile_lock:
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+                if self.profile_stats is None:
+                    self.profile_stats = pstats.Stats(profiler)
+                else:
+                    self.profile_stats.add(profiler)
+
+    def increment(self, counter, value=1):
+        with self.lock:
+            self.counters[counter] += value
+
+    def update(self, counters):
+        with self.lock:
+            self.counters.update(counters)
+
+    def finish(self, success=True):
+        self.finished_at = time.time()
+        self.success = success
+
+    def summary(self):
+        finished_at = time.time() if self.finished_at is None else self.finished_at
+        with self.lock:
+            return {
+                'started_at': self.started_at,
+                'duration_seconds': finished_at - self.started_at,
+                'success': self.success,
+                'stages': {stage: {'seconds': self.stage_seconds[stage], 'calls': self.stage_calls[stage]}
+                           for stage in sorted(self.stage_calls)},
+                'counters': dict(sorted(self.counters.items())),
+            }
+
+    def format_prometheus(self):
+        summary = self.summary()
+        lines = [
+            f'# HELP {PROMETHEUS_PREFIX}_last_run_timestamp_seconds When the last run started',
+            f'# TYPE {PROMETHEUS_PREFIX}_last_run_timestamp_seconds gauge',
+            f'{PROMETHEUS_PREFIX}_last_run_timestamp_seconds {summary["started_at"]}',
+            f'# HELP {PROMETHEUS_PREFIX}_last_run_duration_seconds How long the last run took',
+            f'# TYPE {PROMETHEUS_PREFIX}_last_run_duration_seconds gauge',
+            f'{PROMETHEUS_PREFIX}_last_run_duration_seconds {summary["duration_seconds"]}',
+            f'# HELP {PROMETHEUS_PREFIX}_last_run_success Whether the last run completed without an error',
+            f'# TYPE {PROMETHEUS_PREFIX}_last_run_success gauge',
+            f'{PROMETHEUS_PREFIX}_last_run_success {int(summary["success"])}',
+            f'# HELP {PROMETHEUS_PREFIX}_stage_seconds Time spent in each stage during the last run',
+            f'# TYPE {PROMETHEUS_PREFIX}_stage_seconds gauge',
+        ]
+        for stage, timing in summary['stages'].items():
+            lines.append(f'{PROMETHEUS_PREFIX}_stage_seconds{{stage="{stage}"}} {timing["seconds"]}')
+        lines += [
+            f'# HELP {PROMETHEUS_PREFIX}_stage_calls Times each stage ran during the last run',
+            f'# TYPE {PROMETHEUS_PREFIX}_stage_calls gauge',
+        ]
+        for stage, timing in summary['stages'].items():
+            lines.append(f'{PROMETHEUS_PREFIX}_stage_calls{{stage="{stage}"}} {timing["calls"]}')
+        for counter, value in summary['counters'].items():
+            lines += [
+                f'# HELP {PROMETHEUS_PREFIX}_{counter} {COUNTERS.get(counter, counter)} during the last run',
+                f'# TYPE {PROMETHEUS_PREFIX}_{counter} gauge',
+                f'{PROMETHEUS_PREFIX}_{counter} {value}',
+            ]
+        return str.join('\n', lines) + '\n'
+
+    def write_json(self, path):
+        _write_atomic(path, json.dumps(self.summary(), indent=2) + '\n')
+
+    def write_prometheus(self, path):
+        _write_atomic(path, self.format_prometheus())
+
+    def write_profile(self, path):
+        if self.profile_stats is not None:
+            self.profile_stats.dump_stats(path)
+
+
+def _write_atomic(path, data):
+    # The textfile collector may read at any time, so the file is replaced rather than rewritten in place
+    temporary_path = f'{path}.{os.getpid()}.tmp'
+    with open(temporary_path, 'w') as f:
+        f.write(data)
+    os.replace(temporary_path, path)
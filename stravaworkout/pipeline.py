@@ -0,0 +1,56 @@
+import collections
+import concurrent.futures
+
+
+def _copy_future_state(source, destination):
+    if source.cancelled():
+        destination.cancel()
+    elif source.exception() is not None:
+        destination.set_exception(source.exception())
+    else:
+        destination.set_result(source.result())
+
+
+def _then(future, executor, fn):
+    next_future = concurrent.futures.Future()
+
+    def submit(previous_future):
+        if previous_future.cancelled():
+            next_future.cancel()
+            return
+
+        try:
+            submitted_future = executor.submit(fn, previous_future.result())
+        except BaseException as e:
+            next_future.set_exception(e)
+            return
+
+        submitted_future.add_done_callback(lambda x: _copy_future_state(x, next_future))
+
+    future.add_done_callback(submit)
+    return next_future
+
+
+def run_pipeline(items, stages, max_pending=None):
+    # Each stage is a (fn, workers) pair with its own thread pool, so a slow stage only blocks its own workers.
+    # Results are yielded in the order of items, at most max_pending items are in flight at once.
+    if max_pending is None:
+        max_pending = 2 * sum(map(lambda x: x[1], stages))
+
+    executors = [concurrent.futures.ThreadPoolExecutor(max_workers=workers) for _, workers in stages]
+    try:
+        pending = collections.deque()
+        for item in items:
+            future = executors[0].submit(stages[0][0], item)
+            for executor, (fn, _) in zip(executors[1:], stages[1:]):
+                future = _then(future, executor, fn)
+            pending.append(future)
+
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for executor in executors:
+            executor.shutdown(wait=True, cancel_futures=True)
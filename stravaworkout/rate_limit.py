@@ -0,0 +1,192 @@
+import collections
+import contextlib
+import logging
+import random
+import threading
+import time
+
+import requests.adapters
+
+__log__ = logging.getLogger(__name__)
+
+PRIORITY_NEW = 0
+PRIORITY_BACKFILL = 1
+# The share of each limit that backfill requests leave for new activities
+BACKFILL_RESERVE = 0.25
+
+SHORT_WINDOW = 15 * 60
+LONG_WINDOW = 24 * 60 * 60
+DEFAULT_MAX_WAIT = SHORT_WINDOW
+
+# Header prefix -> (15 minute limit, daily limit) until the headers of a response say otherwise.
+# The read limit only applies to GET requests, the overall limit to all of them.
+OVERALL_LIMIT = 'X-RateLimit'
+READ_LIMIT = 'X-ReadRateLimit'
+API_LIMITS = {
+    OVERALL_LIMIT: (200, 2000),
+    READ_LIMIT: (100, 1000),
+}
+
+RETRIES = 4
+BACKOFF_BASE = 1
+BACKOFF_CAP = 60
+# Server errors are only retried for requests that can safely be sent twice, a 429 was never processed
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+_priority = threading.local()
+
+
+class RateLimitError(Exception):
+    pass
+
+
+@contextlib.contextmanager
+def request_priority(priority):
+    # The priority of the requests made by this thread, such as by a pipeline worker for a backfill job
+    previous = getattr(_priority, 'value', PRIORITY_NEW)
+    _priority.value = priority
+    try:
+        yield
+    finally:
+        _priority.value = previous
+
+
+def get_request_priority():
+    return getattr(_priority, 'value', PRIORITY_NEW)
+
+
+def parse_rate_limit_header(value):
+    try:
+        short, long = map(int, value.split(','))
+    except (AttributeError, ValueError):
+        return None
+    return short, long
+
+
+def get_backoff(attempt):
+    # Full jitter, so workers that failed together do not retry together
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+class TokenBucket:
+    # Strava counts requests in fixed windows, every 15 minutes and every day from midnight UTC, so the bucket is
+    # refilled to its limit when the window ends rather than a token at a time
+    def __init__(self, limit, window, now=None):
+        if now is None:
+            now = time.time()
+        self.limit = limit
+        self.window = window
+        self.tokens = limit
+        self.resets_at = self.get_reset(now)
+
+    def get_reset(self, now):
+        return (now // self.window + 1) * self.window
+
+    def refill(self, now):
+        if now >= self.resets_at:
+            self.tokens = self.limit
+            self.resets_at = self.get_reset(now)
+
+    def has_token(self, reserve=0):
+        return self.tokens - reserve * self.limit >= 1
+
+    def update(self, limit, usage):
+        # The usage also counts requests of other processes of the application, but not requests still in flight
+        self.limit = limit
+        self.tokens = min(self.tokens, limit - usage)
+
+
+class RequestScheduler:
+    # Requests wait for a token from every bucket that applies to them. Backfill requests leave a reserve for new
+    # activities and go after any waiting new request, so a backfill can not hold up the sync of a new activity.
+    # Without limits it only retries, as for the Strava website which does not send rate limit headers.
+    def __init__(self, metrics, limits=None, max_wait=DEFAULT_MAX_WAIT):
+        now = time.time()
+        self.metrics = metrics
+        self.max_wait = max_wait
+        self.buckets = {prefix: (TokenBucket(short, SHORT_WINDOW, now), TokenBucket(long, LONG_WINDOW, now))
+                        for prefix, (short, long) in (limits or {}).items()}
+        self.condition = threading.Condition()
+        self.waiting = collections.Counter()
+
+    def get_buckets(self, method):
+        return [bucket for prefix, buckets in self.buckets.items()
+                if prefix != READ_LIMIT or method in ('GET', 'HEAD') for bucket in buckets]
+
+    def acquire(self, method, priority=None):
+        if priority is None:
+            priority = get_request_priority()
+        buckets = self.get_buckets(method)
+        reserve = 0 if priority <= PRIORITY_NEW else BACKFILL_RESERVE
+
+        with self.condition:
+            self.waiting[priority] += 1
+            try:
+                while True:
+                    now = time.time()
+                    for bucket in buckets:
+                        bucket.refill(now)
+
+                    empty = [bucket for bucket in buckets if not bucket.has_token(reserve)]
+                    if not empty and not any(self.waiting[x] for x in self.waiting if x < priority):
+                        break
+
+                    timeout = None
+                    if empty:
+                        timeout = max(map(lambda x: x.resets_at, empty)) - now
+                        if timeout > self.max_wait:
+                            raise RateLimitError(f"Strava rate limit reached, it resets in {timeout:.0f} seconds")
+                        __log__.info("Strava rate limit reached, waiting %.0f seconds", timeout)
+                    with self.metrics.time('rate_limit_wait'):
+                        self.condition.wait(timeout)
+
+                for bucket in buckets:
+                    bucket.tokens -= 1
+            finally:
+                self.waiting[priority] -= 1
+                self.condition.notify_all()
+
+    def update(self, headers):
+        with self.condition:
+            for prefix, buckets in self.buckets.items():
+                limits = parse_rate_limit_header(headers.get(f'{prefix}-Limit'))
+                usages = parse_rate_limit_header(headers.get(f'{prefix}-Usage'))
+                if limits is None or usages is None:
+                    continue
+                for bucket, limit, usage in zip(buckets, limits, usages):
+                    bucket.update(limit, usage)
+
+
+class ScheduledAdapter(requests.adapters.HTTPAdapter):
+    # Sends every request of a session through the scheduler, retrying rate limited requests and server errors
+    def __init__(self, scheduler, retries=RETRIES):
+        super().__init__()
+        self.scheduler = scheduler
+        self.retries = retries
+
+    def send(self, request, **kwargs):
+        attempt = 0
+        while True:
+            self.scheduler.acquire(request.method)
+            response = super().send(request, **kwargs)
+            self.scheduler.update(response.headers)
+
+            retry = response.status_code == 429 or (response.status_code >= 500
+                                                    and request.method in IDEMPOTENT_METHODS)
+            if not retry or attempt >= self.retries:
+                return response
+
+            backoff = get_backoff(attempt)
+            __log__.warning("%s %s returned %s, retrying in %.1f seconds", request.method,
+                            request.url.split('?')[0], response.status_code, backoff)
+            self.scheduler.metrics.increment('api_retries')
+            response.close()
+            with self.scheduler.metrics.time('retry_backoff'):
+                time.sleep(backoff)
+            attempt += 1
+
+
+def mount_scheduler(session, scheduler):
+    session.mount('https://', ScheduledAdapter(scheduler))
+    session.mount('http://', ScheduledAdapter(scheduler))
+    return session
@@ -0,0 +1,331 @@
+import datetime
+import functools
+from collections import namedtuple
+
+from fingerprint import get_duration_value, get_session_metrics, get_workout_fingerprint, iter_work_steps
+from format_utils import format_distance, format_heart_rate, format_speed_as_pace, format_time, round_time_to_seconds
+from workout_types import RepeatStep, WorkStep, WorkStepRepeat
+
+FORMATS = ('title', 'description', 'rows', 'json')
+DETAILS = ('activity', 'repeat', 'lap')
+
+DESCRIPTION_FOOTER = 'Work in progress @ https://github.com/dylanmckendry/StravaWorkout'
+
+# rows are dicts keyed by the CSV columns without the file, data is a dict that can be dumped as JSON.
+# Formats that were not asked for are None.
+Rendering = namedtuple('Rendering', ['title', 'description', 'rows', 'data'])
+
+# The parts of one step in each format, None where the step is left out of that format
+StepRendering = namedtuple('StepRendering', ['title', 'summary', 'breakdown', 'data'])
+
+
+class StepMetrics:
+    # The aggregates of a work step over its repeats, shared by all formats. Each is computed on first use only,
+    # as not every step needs all of them, such as the speed of a rest that covers no distance.
+    def __init__(self, work_step):
+        self.repeats = work_step.repeats
+
+    @functools.cached_property
+    def total_distance(self):
+        distances = [x.total_distance() for x in self.repeats]
+        return None if None in distances else sum(distances)
+
+    @functools.cached_property
+    def total_seconds(self):
+        return sum(map(lambda x: x.total_seconds(), self.repeats))
+
+    @functools.cached_property
+    def avg_distance(self):
+        return None if self.total_distance is None else self.total_distance / len(self.repeats)
+
+    @functools.cached_property
+    def avg_time(self):
+        return datetime.timedelta(seconds=self.total_seconds / len(self.repeats))
+
+    @functools.cached_property
+    def avg_speed(self):
+        speeds = [x.avg_speed() for x in self.repeats]
+        if None in speeds:
+            return None
+        return sum(map(lambda x, y: x * y.total_seconds(), speeds, self.repeats)) / self.total_seconds
+
+    @functools.cached_property
+    def repeat_paces(self):
+        return ['-' if x.avg_speed() is None else format_speed_as_pace(x.avg_speed()) for x in self.repeats]
+
+
+def get_repeat_values(repeat):
+    distance = repeat.total_distance()
+    time = repeat.total_seconds()
+    values = {
+        'distance': None if distance is None else round(distance, 2),
+        'time': round(time, 3),
+        'ascent': repeat.total_ascent(),
+        'descent': repeat.total_descent(),
+    }
+
+    if distance and time > 0:
+        values['speed'] = round(distance / time, 3)
+        values['pace'] = format_speed_as_pace(distance / time)
+    if time > 0 and repeat.avg_heart_rate() is not None:
+        values['heart_rate'] = round(repeat.avg_heart_rate())
+
+    return values
+
+
+def get_analysis_values(analysis):
+    if analysis is None:
+        return {}
+    return {
+        'fastest_split': analysis.fastest_split,
+        'pace_variability': analysis.pace_variability,
+        'heart_rate_drift': analysis.heart_rate_drift,
+        'time_to_target_pace': analysis.time_to_target_pace,
+    }
+
+
+class WorkoutRenderer:
+    # Renders workouts in several formats from one walk of the step tree. The title, summary and repeat breakdown
+    # of a step are built together, from step metrics that are computed once and shared with the rows and JSON.
+    # One renderer can render any number of workouts, duration labels are reused across them.
+    def __init__(self, formats=('title', 'description'), detail='activity'):
+        unknown_formats = set(formats) - set(FORMATS)
+        if unknown_formats:
+            raise ValueError(f"Unknown formats {sorted(unknown_formats)}")
+        if detail not in DETAILS:
+            raise ValueError(f"Unknown detail \"{detail}\"")
+
+        self.formats = formats
+        self.detail = detail
+        self.duration_labels = {}
+        # Step summaries and breakdowns, the analysis and the comparison only make up the description, which the
+        # rows and JSON include as well. A title on its own is rendered without them.
+        self.describe = bool({'description', 'rows', 'json'} & set(formats))
+
+    def render(self, workout, previous_sessions=()):
+        # previous_sessions are the session metrics of earlier workouts with the same fingerprint, newest first
+        metrics = {index: StepMetrics(work_step) for index, work_step in workout.work_steps.items()}
+        titles = {}
+        steps = [self.render_step(step, '', metrics, titles) for step in workout.steps]
+
+        title = str.join('; ', [x.title for x in steps if x.title is not None])
+        description = None
+        if self.describe:
+            descriptions = [
+                str.join('; ', [x.summary for x in steps if x.summary is not None]),
+                DESCRIPTION_FOOTER,
+                str.join('\n', [x.breakdown for x in steps]),
+            ]
+            analysis_description = self.render_analysis(workout, titles)
+            if analysis_description:
+                descriptions.append(analysis_description)
+            comparison_description = self.render_comparison(workout, titles, previous_sessions)
+            if comparison_description:
+                descriptions.append(comparison_description)
+            description = str.join('\n\n', descriptions)
+
+        rows = None
+        if 'rows' in self.formats:
+            rows = self.render_rows(workout, title, description)
+
+        data = None
+        if 'json' in self.formats:
+            data = {'title': title, 'description': description, 'weight': workout.profile,
+                    'fingerprint': get_workout_fingerprint(workout), 'steps': [x.data for x in steps]}
+
+        return Rendering(title if 'title' in self.formats else None,
+                         description if 'description' in self.formats else None,
+                         rows, data)
+
+    def render_step(self, step, breakdown_prefix, metrics, titles):
+        if isinstance(step, WorkStep):
+            return self.render_work_step(step, breakdown_prefix, metrics[step.index], titles)
+        elif isinstance(step, RepeatStep):
+            return self.render_repeat_step(step, metrics, titles)
+        else:
+            raise ValueError(f"type(step) = {type(step)}")
+
+    def render_repeat_step(self, repeat_step, metrics, titles):
+        steps = [self.render_step(x, '- ', metrics, titles) for x in repeat_step.steps]
+        title = f"{repeat_step.repeat_times} * {str.join(' ⇒ ', [x.title for x in steps if x.title is not None])}"
+        summary = None
+        breakdown = None
+        if self.describe:
+            summary = f"{repeat_step.repeat_times} * " \
+                      f"{str.join(' ⇒ ', [x.summary for x in steps if x.summary is not None])}"
+            breakdowns = str.join('\n', [x.breakdown for x in steps])
+            breakdown = f"{summary}:\n{breakdowns}"
+
+        data = None
+        if 'json' in self.formats:
+            data = {'index': repeat_step.index, 'step_type': repeat_step.step_type,
+                    'repeat_times': repeat_step.repeat_times, 'summary': summary,
+                    'steps': [x.data for x in steps]}
+
+        return StepRendering(title, summary, breakdown, data)
+
+    def render_work_step(self, work_step, breakdown_prefix, metrics, titles):
+        title = None
+        if work_step.step_type == 'active' or work_step.step_type == 'interval':
+            title = self.render_work_step_title(work_step)
+            titles[work_step.index] = title
+
+        summary = None
+        breakdown = None
+        if self.describe:
+            if work_step.step_type != 'warmup' and work_step.step_type != 'cooldown':
+                summary = self.render_work_step_summary(work_step, metrics)
+            breakdown = breakdown_prefix + self.render_work_step_breakdown(work_step, metrics)
+
+        data = None
+        if 'json' in self.formats:
+            data = {'index': work_step.index, 'step_type': work_step.step_type,
+                    'duration_type': work_step.duration_type, 'duration': get_duration_value(work_step.duration),
+                    'target_type': work_step.target_type, 'target_low': work_step.target_low,
+                    'target_high': work_step.target_high, 'summary': summary,
+                    'repeats': [dict(get_repeat_values(x), **get_analysis_values(x.analysis))
+                                for x in work_step.repeats]}
+
+        return StepRendering(title, summary, breakdown, data)
+
+    def get_duration_label(self, work_step):
+        key = (work_step.duration_type, work_step.duration)
+        label = self.duration_labels.get(key)
+        if label is None:
+            if work_step.duration_type == 'time':
+                label = format_time(work_step.duration)
+            elif work_step.duration_type == 'distance':
+                label = format_distance(work_step.duration)
+            elif work_step.duration_type == 'hr_less_than':
+                label = f'<{format_heart_rate(work_step.duration)}'
+            else:
+                raise ValueError(f"Unknown duration_type \"{work_step.duration_type}\" "
+                                 f"for step_type \"{work_step.step_type}\"")
+            self.duration_labels[key] = label
+        return label
+
+    def render_work_step_title(self, work_step):
+        if work_step.duration_type != 'time' and work_step.duration_type != 'distance':
+            raise ValueError(f"work_step.duration_type = {work_step.duration_type}")
+        return self.get_duration_label(work_step)
+
+    def render_work_step_summary(self, work_step, metrics):
+        if work_step.step_type == 'rest':
+            return format_time(round_time_to_seconds(metrics.avg_time))
+        elif work_step.step_type == 'recovery' or work_step.step_type == 'active' or work_step.step_type == 'interval':
+            # Laps recorded without distance or speed are summarised by their time
+            if (work_step.step_type == 'recovery' and work_step.duration_type == 'time') \
+                    or metrics.avg_distance is None:
+                summary = format_time(round_time_to_seconds(metrics.avg_time))
+            else:
+                summary = format_distance(metrics.avg_distance)
+            return self.render_pace(summary, metrics)
+        else:
+            raise ValueError(f"work_step.step_type = {work_step.step_type}")
+
+    def render_work_step_breakdown(self, work_step, metrics):
+        if work_step.step_type == 'warmup':
+            return self.render_pace(f'WU: {self.render_total(metrics)}', metrics)
+        elif work_step.step_type == 'cooldown':
+            return self.render_pace(f'CD: {self.render_total(metrics)}', metrics)
+        elif work_step.step_type in ('active', 'interval', 'recovery', 'rest'):
+            breakdown = self.get_duration_label(work_step)
+            if work_step.target_type == 'speed':
+                breakdown += ': ' + str.join(', ', metrics.repeat_paces)
+            return breakdown
+        else:
+            raise ValueError(f"Unknown step_type \"{work_step.step_type}\"")
+
+    def render_total(self, metrics):
+        if metrics.total_distance is None:
+            return format_time(round_time_to_seconds(datetime.timedelta(seconds=metrics.total_seconds)))
+        return format_distance(metrics.total_distance)
+
+    def render_pace(self, summary, metrics):
+        if metrics.avg_speed is None:
+            return summary
+        return f"{summary} @ {format_speed_as_pace(metrics.avg_speed)}"
+
+    def render_analysis(self, workout, titles):
+        work_steps = [x for x in workout.work_steps.values()
+                      if (x.step_type == 'active' or x.step_type == 'interval')
+                      and any(map(lambda y: y.analysis is not None, x.repeats))]
+        return str.join('\n', map(lambda x: self.render_work_step_analysis(x, titles[x.index]), work_steps))
+
+    def render_work_step_analysis(self, work_step, title):
+        # The fastest split is the best of all repeats, the other metrics are averaged over the repeats
+        analyses = [x.analysis for x in work_step.repeats if x.analysis is not None]
+        descriptions = []
+
+        fastest_splits = [x.fastest_split for x in analyses if x.fastest_split is not None]
+        if fastest_splits:
+            fastest_split = datetime.timedelta(seconds=min(fastest_splits))
+            descriptions.append(f"best {format_distance(analyses[0].split_distance)} "
+                                f"{format_time(round_time_to_seconds(fastest_split))}")
+
+        pace_variabilities = [x.pace_variability for x in analyses if x.pace_variability is not None]
+        if pace_variabilities:
+            descriptions.append(f"pace ±{sum(pace_variabilities) / len(pace_variabilities):.1%}")
+
+        heart_rate_drifts = [x.heart_rate_drift for x in analyses if x.heart_rate_drift is not None]
+        if heart_rate_drifts:
+            # Adding 0 turns a rounded -0.0 into 0.0
+            heart_rate_drift = round(sum(heart_rate_drifts) / len(heart_rate_drifts), 3) + 0
+            descriptions.append(f"HR drift {heart_rate_drift:+.1%}")
+
+        times_to_target_pace = [x.time_to_target_pace for x in analyses if x.time_to_target_pace is not None]
+        if times_to_target_pace:
+            time_to_target_pace = datetime.timedelta(seconds=sum(times_to_target_pace) / len(times_to_target_pace))
+            descriptions.append(f"on pace after {format_time(round_time_to_seconds(time_to_target_pace))}")
+
+        return f"{title}: {str.join(', ', descriptions)}"
+
+    def render_comparison(self, workout, titles, previous_sessions):
+        # The pace of each active step against its average pace in the previous sessions
+        if not previous_sessions:
+            return ''
+
+        session = get_session_metrics(workout)
+        comparisons = []
+        for position, work_step in enumerate(iter_work_steps(workout.steps)):
+            speed = session[position]['speed']
+            if work_step.step_type not in ('active', 'interval') or speed is None:
+                continue
+
+            previous_speeds = [x[position]['speed'] for x in previous_sessions
+                               if position < len(x) and x[position]['speed'] is not None]
+            if not previous_speeds:
+                continue
+
+            previous_pace = sum(map(lambda x: 1000 / x, previous_speeds)) / len(previous_speeds)
+            comparisons.append(f"{titles[work_step.index]} {round(1000 / speed - previous_pace):+d}s/km")
+
+        if not comparisons:
+            return ''
+        occurrences = 'last time' if len(previous_sessions) == 1 else f'last {len(previous_sessions)}'
+        return f"vs {occurrences}: {str.join(', ', comparisons)}"
+
+    def render_rows(self, workout, title, description):
+        laps = [lap for work_step in workout.work_steps.values() for repeat in work_step.repeats for lap in repeat.laps]
+        rows = [dict(get_repeat_values(WorkStepRepeat(laps)), row_type='activity', title=title,
+                     description=description)]
+
+        if self.detail == 'activity':
+            return rows
+
+        for work_step in workout.work_steps.values():
+            step = {'step_index': work_step.index, 'step_type': work_step.step_type}
+            for repeat_number, repeat in enumerate(work_step.repeats, 1):
+                rows.append(dict(get_repeat_values(repeat), row_type='repeat', repeat=repeat_number, **step,
+                                 **get_analysis_values(repeat.analysis)))
+
+                if self.detail == 'lap':
+                    for lap_number, lap in enumerate(repeat.laps, 1):
+                        rows.append(dict(get_repeat_values(WorkStepRepeat([lap])), row_type='lap',
+                                         repeat=repeat_number, lap=lap_number, **step))
+
+        return rows
+
+
+def render_workout(workout, formats=('title', 'description'), detail='activity', previous_sessions=()):
+    return WorkoutRenderer(formats, detail).render(workout, previous_sessions)
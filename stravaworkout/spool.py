@@ -0,0 +1,64 @@
+import hashlib
+import tempfile
+
+DEFAULT_SPOOL_SIZE = 4 * 1024 * 1024
+READ_CHUNK_SIZE = 64 * 1024
+
+
+class ChunkSpool:
+    # Passes a stream of byte chunks through while keeping a copy, so the stream can be replayed or read as a file.
+    # The copy is held in memory and only spills to a temporary file once it grows beyond max_size bytes.
+    def __init__(self, chunks, max_size=DEFAULT_SPOOL_SIZE):
+        self._chunks = iter(chunks)
+        self._spool = tempfile.SpooledTemporaryFile(max_size=max_size)
+        self._hash = hashlib.sha256()
+        self.size = 0
+
+    def iter_chunks(self):
+        # Replay what has already been read, then carry on with the live stream
+        self._spool.seek(0, 0)
+        while True:
+            chunk = self._spool.read(READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+        for chunk in self._chunks:
+            self._write(chunk)
+            yield chunk
+
+    def _write(self, chunk):
+        self._spool.write(chunk)
+        self._hash.update(chunk)
+        self.size += len(chunk)
+
+    def _drain(self):
+        position = self._spool.tell()
+        self._spool.seek(0, 2)
+        for chunk in self._chunks:
+            self._write(chunk)
+        self._spool.seek(position, 0)
+
+    def content_hash(self):
+        self._drain()
+        return self._hash.hexdigest()
+
+    def read(self, size=-1):
+        self._drain()
+        return self._spool.read(size)
+
+    def seek(self, offset, whence=0):
+        self._drain()
+        return self._spool.seek(offset, whence)
+
+    def tell(self):
+        return self._spool.tell()
+
+    def close(self):
+        self._spool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
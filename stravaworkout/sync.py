@@ -0,0 +1,535 @@
+import collections
+import configparser
+import contextlib
+import datetime
+import functools
+import logging
+import re
+import time
+
+import requests
+from stravalib import Client
+from stravalib.exc import AccessUnauthorized, AuthError, LoginFailed, RateLimitExceeded
+from stravaweblib import WebClient
+
+from archive import FitArchive
+from credentials import get_tokens, load_credentials, save_credentials
+from fingerprint import get_session_metrics, get_workout_fingerprint
+from metrics import Metrics
+from pipeline import run_pipeline
+from rate_limit import (API_LIMITS, PRIORITY_BACKFILL, PRIORITY_NEW, RateLimitError, RequestScheduler,
+                        mount_scheduler, request_priority)
+from renderer import render_workout
+from spool import ChunkSpool, DEFAULT_SPOOL_SIZE
+from sync_state import SyncState
+from workout_cache import WorkoutCache, MISSING
+from workout_parser import create_workout, get_parser_version
+
+__log__ = logging.getLogger(__name__)
+
+DEFAULT_ACTIVITY_LIMIT = 5
+# Access tokens are refreshed this many seconds before they expire
+TOKEN_REFRESH_MARGIN = 5 * 60
+# Failed activities are retried by later runs until they failed this many times
+MAX_FAILURE_ATTEMPTS = 3
+# Errors that every following request would also run into, so they stop the run instead of failing one activity
+FATAL_ERRORS = (RateLimitError, RateLimitExceeded, AuthError, AccessUnauthorized)
+
+ActivityFile = collections.namedtuple('ActivityFile', ['filename', 'content', 'response'])
+
+
+class ActivityWebClient(WebClient):
+    # stravaweblib only returns the body of a download, the response is kept with it so it can be closed unread
+    @staticmethod
+    def _make_export_file(resp, id_, fmt):
+        export_file = WebClient._make_export_file(resp, id_, fmt)
+        return ActivityFile(export_file.filename, export_file.content, resp)
+
+
+class ActivityJob:
+    def __init__(self, activity, previous=None, priority=PRIORITY_NEW):
+        self.activity = activity
+        self.previous = previous
+        self.priority = priority
+        self.filename = None
+        self.file = None
+        self.content_hash = None
+        self.workout = None
+        self.fingerprint = None
+        self.session = None
+        self.cached = False
+        self.archived = False
+        self.name = None
+        self.description = None
+        self.updated = False
+        self.error = None
+
+    def unchanged(self):
+        return (self.previous is not None
+                and self.previous.content_hash == self.content_hash
+                and self.previous.name == self.name
+                and self.previous.description == self.description)
+
+
+def is_same_upload(activity, previous):
+    # Replacing or cropping an activity on Strava changes these, and with them the file it exports
+    return (previous is not None and previous.content_hash is not None
+            and previous.upload_id == activity.upload_id and previous.elapsed_time == activity.elapsed_time)
+
+
+def download_activity(client, spool_size, cache, metrics, job, archive=None):
+    # A workout parsed from the same FIT file before is reused without downloading it again
+    same_upload = is_same_upload(job.activity, job.previous)
+    if cache is not None and same_upload:
+        workout = cache.get(job.previous.content_hash)
+        if workout is not MISSING:
+            job.content_hash = job.previous.content_hash
+            job.workout = workout
+            job.cached = True
+            metrics.increment('activities_cached')
+            return job
+
+    # A FIT file downloaded before is decompressed from the archive as it is parsed
+    if archive is not None and same_upload and job.previous.content_hash in archive:
+        job.file = archive.open(job.previous.content_hash)
+        job.archived = True
+        metrics.increment('activities_archived')
+        return job
+
+    # The body is only read while parsing, so this times the request up to the response headers
+    with metrics.time('download'), request_priority(job.priority):
+        data = client.get_activity_data(job.activity.id)
+    metrics.increment('api_calls')
+    job.filename = data.filename
+
+    # The body is streamed straight into the decoder by parse_activity, a copy is only kept for the fallback decoder
+    if job.filename.endswith('.fit'):
+        job.file = ChunkSpool(data.content, spool_size)
+    else:
+        # Only FIT files are parsed, the rest of the body is not downloaded
+        data.response.close()
+
+    return job
+
+
+def get_previous_sessions(state, fingerprint, start_date, limit):
+    if state is None or limit <= 0 or start_date is None:
+        return []
+    return state.get_previous_sessions(fingerprint, start_date, limit)
+
+
+def parse_activity(decoder, analysis, cache, metrics, job, state=None, compare_sessions=0, archive=None):
+    if job.file is not None:
+        stats = collections.Counter()
+        with job.file as file:
+            # The download is streamed into the decoder, so this includes the time spent reading the body
+            with metrics.time('decode'), metrics.profile():
+                job.workout = create_workout(file, decoder, stats)
+                job.content_hash = file.content_hash()
+            if not job.archived:
+                stats['bytes_downloaded'] += file.size
+
+            # The spool still has the whole file, it is archived before it is closed
+            if archive is not None and not job.archived:
+                with metrics.time('archive'):
+                    archive.put(job.content_hash, file.iter_chunks())
+
+            if analysis and job.workout is not None:
+                # numpy is only loaded when the analysis is asked for
+                from analysis import analyse_workout
+                with metrics.time('analysis'):
+                    analyse_workout(file, job.workout)
+        job.file = None
+        metrics.update(stats)
+
+        if cache is not None:
+            cache.put(job.content_hash, job.workout)
+
+    if job.workout is not None:
+        with metrics.time('render'):
+            # Earlier sessions of the same workout are looked up by fingerprint for the comparison
+            job.fingerprint = get_workout_fingerprint(job.workout)
+            job.session = get_session_metrics(job.workout)
+            previous_sessions = get_previous_sessions(state, job.fingerprint, job.activity.start_date,
+                                                      compare_sessions)
+            rendering = render_workout(job.workout, previous_sessions=previous_sessions)
+            job.name = rendering.title
+            job.description = rendering.description
+
+    return job
+
+
+def get_changed_fields(job):
+    # Activity summaries have no description, the description we last wrote stands in for it
+    description = job.activity.description
+    if description is None and job.previous is not None:
+        description = job.previous.description
+
+    fields = {}
+    if job.name != job.activity.name:
+        fields['name'] = job.name
+    if job.description != description:
+        fields['description'] = job.description
+    return fields
+
+
+def upload_activity(client, metrics, job, force_update=False):
+    if job.name is None:
+        return job
+
+    # Only the changed fields are sent, in one update. Output that has not changed since we last wrote it is not
+    # written again, so an activity renamed by the athlete keeps its name until the workout itself changes.
+    if force_update:
+        fields = {'name': job.name, 'description': job.description}
+    elif job.unchanged():
+        fields = {}
+    else:
+        fields = get_changed_fields(job)
+
+    if not fields:
+        metrics.increment('activities_unchanged')
+        return job
+
+    with metrics.time('upload'), request_priority(job.priority):
+        client.update_activity(job.activity.id, **fields)
+    metrics.increment('api_calls')
+    metrics.increment('activities_updated')
+    job.updated = True
+
+    return job
+
+
+def run_job_stage(stage, metrics, job):
+    # One activity failing does not stop the others, a failed job passes through the later stages untouched
+    if job.error is not None:
+        return job
+
+    try:
+        return stage(job)
+    except FATAL_ERRORS:
+        raise
+    except Exception as e:
+        __log__.warning("Failed to process activity %s", job.activity, exc_info=True)
+        metrics.increment('activities_failed')
+        job.error = f"{type(e).__name__}: {e}"
+        if job.file is not None:
+            job.file.close()
+            job.file = None
+        return job
+
+
+def create_activity_jobs(activities, state=None, reprocess=False, priority=PRIORITY_NEW, skip_given_up=True):
+    for activity in activities:
+        if activity.type != 'Run':
+            continue
+
+        previous = None if state is None else state.get_activity(activity.id)
+        if previous is not None and not reprocess:
+            continue
+
+        if skip_given_up and state is not None and state.get_failure_attempts(activity.id) >= MAX_FAILURE_ATTEMPTS:
+            __log__.info("Skipped activity %s, it failed %d times", activity, MAX_FAILURE_ATTEMPTS)
+            continue
+
+        yield ActivityJob(activity, previous, priority)
+
+
+def process_activities(client, jobs, decoder='fast', download_workers=1, parse_workers=1, upload_workers=1,
+                       spool_size=DEFAULT_SPOOL_SIZE, cache=None, metrics=None, analysis=False, force_update=False,
+                       state=None, compare_sessions=0, archive=None):
+    if metrics is None:
+        metrics = Metrics()
+
+    # Downloads, parsing and uploads of different activities overlap, the jobs come back in activity order
+    stages = [
+        (functools.partial(download_activity, client, spool_size, cache, metrics, archive=archive), download_workers),
+        (functools.partial(parse_activity, decoder, analysis, cache, metrics, state=state,
+                           compare_sessions=compare_sessions, archive=archive), parse_workers),
+        (functools.partial(upload_activity, client, metrics, force_update=force_update), upload_workers),
+    ]
+    return run_pipeline(jobs, [(functools.partial(run_job_stage, stage, metrics), workers)
+                               for stage, workers in stages])
+
+
+def sync_activities(client, state, cache, metrics, jobs, args, archive=None):
+    # Returns the ids of the activities that failed
+    failed = set()
+    for job in process_activities(client, jobs, args.decoder,
+                                  args.download_workers, args.parse_workers, args.upload_workers,
+                                  args.spool_size, cache, metrics, args.analysis, args.force_update,
+                                  state, args.compare_sessions, archive):
+        metrics.increment('activities_processed')
+        if job.error is not None:
+            state.record_failure(job.activity.id, job.activity.start_date, job.error)
+            failed.add(job.activity.id)
+            continue
+
+        state.record_activity(job.activity, job.content_hash, job.name, job.description)
+        if job.fingerprint is not None:
+            state.record_session(job.activity.id, job.activity.start_date, job.fingerprint, job.session)
+
+        if job.content_hash is None:
+            continue
+
+        if job.archived:
+            __log__.info("Read activity %s from the archive", job.activity)
+        elif not job.cached:
+            __log__.info("Downloaded activity %s (%s)", job.activity, job.filename)
+        if job.updated:
+            print(job.name)
+            print(job.description)
+            print()
+
+    return failed
+
+
+def retry_failed_activities(client, state, cache, metrics, args, archive=None):
+    # Failed activities are fetched by id, as the runs after the failure may not list them again.
+    # Returns the ids of the activities that failed again.
+    activities = []
+    failed = set()
+    for activity_id in state.iter_failures(MAX_FAILURE_ATTEMPTS):
+        try:
+            with metrics.time('get_activity'), request_priority(PRIORITY_BACKFILL):
+                activities.append(client.get_activity(activity_id))
+        except FATAL_ERRORS:
+            raise
+        except Exception as e:
+            # The activity may have been deleted or made private since it failed
+            __log__.warning("Failed to get activity %s", activity_id, exc_info=True)
+            state.record_failure(activity_id, None, f"{type(e).__name__}: {e}")
+            failed.add(activity_id)
+        finally:
+            metrics.increment('api_calls')
+
+    if activities:
+        __log__.info("Retrying %d failed activities", len(activities))
+        jobs = create_activity_jobs(activities, state, True, PRIORITY_BACKFILL)
+        failed |= sync_activities(client, state, cache, metrics, jobs, args, archive)
+    return failed
+
+
+def sync_latest_activities(client, state, cache, metrics, args, archive=None):
+    # The window reaches back before the last synced activity, so activities uploaded late are still synced and
+    # --reprocess has recent activities to work on. Synced ones are skipped by create_activity_jobs.
+    # The first run falls back to the latest few.
+    retry_failed_activities(client, state, cache, metrics, args, archive)
+
+    latest = state.latest_start_date()
+    with metrics.time('get_activities'):
+        if latest is None:
+            activities = list(client.get_activities(limit=DEFAULT_ACTIVITY_LIMIT))
+        else:
+            activities = list(client.get_activities(after=latest - datetime.timedelta(days=args.lookback_days)))
+    metrics.increment('api_calls')
+
+    sync_activities(client, state, cache, metrics, create_activity_jobs(activities, state, args.reprocess), args,
+                    archive)
+
+
+def backfill_activities(client, state, cache, metrics, args, archive=None):
+    # Works back through the history a batch at a time, the cursor is saved after each batch so it can resume.
+    # Its requests leave part of the rate limits for the sync of new activities.
+    before, completed = state.get_backfill_cursor()
+    if completed:
+        __log__.info("Backfill already completed")
+        return
+
+    retried_failures = retry_failed_activities(client, state, cache, metrics, args, archive)
+
+    while True:
+        with metrics.time('get_activities'), request_priority(PRIORITY_BACKFILL):
+            activities = list(client.get_activities(before=before, limit=args.backfill_batch_size))
+        metrics.increment('api_calls')
+        if len(activities) == 0:
+            state.set_backfill_cursor(before, completed=True)
+            __log__.info("Backfill completed")
+            return
+
+        # Activities that just failed again when retried are not tried twice in one run
+        jobs = create_activity_jobs(filter(lambda x: x.id not in retried_failures, activities), state, args.reprocess,
+                                    PRIORITY_BACKFILL)
+        failed = sync_activities(client, state, cache, metrics, jobs, args, archive)
+        failed |= set(filter(lambda x: x in retried_failures, map(lambda x: x.id, activities)))
+
+        if failed:
+            # The cursor stops before the newest failed activity, so the next backfill lists it again once it was
+            # retried or given up on
+            newest_failed = max(map(lambda x: x.start_date, filter(lambda x: x.id in failed, activities)))
+            newer = [x.start_date for x in activities if x.start_date > newest_failed]
+            if newer:
+                before = min(newer)
+                state.set_backfill_cursor(before)
+            __log__.info("Backfill stopped at %d failed activities, they are retried by the next run", len(failed))
+            return
+
+        before = min(map(lambda x: x.start_date, activities))
+        state.set_backfill_cursor(before)
+        __log__.info("Backfilled %d activities up to %s", len(activities), before)
+
+
+def rerender_activities(client, state, cache, metrics, args, archive=None):
+    # Regenerates the title and description of every synced activity, from the cache or the archive where possible
+    jobs = (ActivityJob(activity, activity, PRIORITY_BACKFILL) for activity in state.iter_activities())
+    sync_activities(client, state, cache, metrics, jobs, args, archive)
+
+
+def sync_main(args):
+    run_with_metrics(sync_strava, args)
+
+
+def run_with_metrics(run, args):
+    # The metrics are written even when the run fails, so failures show up in the exported metrics
+    metrics = Metrics(profile=args.profile_decode is not None)
+    try:
+        run(args, metrics)
+        metrics.finish()
+    except BaseException:
+        metrics.finish(success=False)
+        raise
+    finally:
+        write_metrics(metrics, args)
+
+
+def write_metrics(metrics, args):
+    if args.metrics_json is not None:
+        metrics.write_json(args.metrics_json)
+    if args.metrics_prometheus is not None:
+        metrics.write_prometheus(args.metrics_prometheus)
+    if args.profile_decode is not None:
+        metrics.write_profile(args.profile_decode)
+
+
+def read_config(args):
+    config_data = args.config.read()
+    config = configparser.ConfigParser()
+    config.read_string(config_data)
+    return config_data, config
+
+
+def get_access_token(args, config_data, config, metrics):
+    # A token saved by an earlier run is used until shortly before it expires, so short runs need no refresh
+    tokens = get_tokens(load_credentials(args.credentials, config))
+    if tokens is not None and tokens['expires_at'] - TOKEN_REFRESH_MARGIN >= time.time():
+        return tokens
+    return refresh_access_token(args, config_data, config, metrics)
+
+
+def refresh_access_token(args, config_data, config, metrics):
+    client_id = int(config['api']['client_id'])
+    client_secret = config['api']['client_secret']
+    # The saved refresh token is the latest, the one in the config file may not have been updated
+    saved_tokens = get_tokens(load_credentials(args.credentials, config))
+    refresh_token = config['api']['refresh_token'] if saved_tokens is None else saved_tokens['refresh_token']
+
+    with metrics.time('refresh_token'):
+        tokens = Client(rate_limit_requests=False).refresh_access_token(client_id, client_secret, refresh_token)
+    metrics.increment('api_calls')
+    save_credentials(args.credentials, config, **tokens)
+
+    refresh_token = config['api']['refresh_token']
+    if tokens['refresh_token'] != refresh_token:
+        refresh_token = tokens['refresh_token']
+        config_path = args.config.name
+        try:
+            if config_path == "<stdin>":
+                raise FileNotFoundError("Cannot write to config file passed via stdin")
+            with open(config_path, 'w') as f:
+                new_config = re.sub(
+                    r'^(\s*refresh_token\s*=\s*)\w+(.*)$',
+                    r'\1{}\2'.format(refresh_token),
+                    config_data,
+                    flags=re.M
+                )
+                f.write(new_config)
+        except OSError:
+            __log__.warning(
+                "Failed to automatically update refresh token in the config file - "
+                "please update it manually", exc_info=True
+            )
+            __log__.warning("New refresh token is '%s'", refresh_token)
+        # Kept for the next refresh of a long running process
+        config['api']['refresh_token'] = refresh_token
+
+    return tokens
+
+
+def refresh_expiring_token(client, args, config_data, config, metrics, tokens):
+    # Long running commands outlive the access token, it is refreshed shortly before it expires
+    if tokens['expires_at'] - TOKEN_REFRESH_MARGIN >= time.time():
+        return tokens
+
+    try:
+        tokens = refresh_access_token(args, config_data, config, metrics)
+        client.access_token = tokens['access_token']
+    except Exception:
+        # Retried on the next call, the old token is valid for a few more minutes
+        __log__.warning("Failed to refresh the access token", exc_info=True)
+    return tokens
+
+
+def resume_web_session(jwt, tokens, session, metrics):
+    # The saved session was checked to be the athlete of the access token when it was saved, so the access
+    # token is set after logging in to skip that check
+    try:
+        with metrics.time('login'):
+            client = ActivityWebClient(jwt=jwt, rate_limit_requests=False, requests_session=session)
+    except (LoginFailed, ValueError) as e:
+        __log__.info("The saved Strava session can no longer be used, logging in again: %s", e)
+        return None
+    finally:
+        metrics.increment('api_calls')
+
+    client.access_token = tokens['access_token']
+    return client
+
+
+def create_client(args, config, tokens, metrics):
+    email = config['user']['email']
+    password = config['user']['password']
+
+    # The scheduler replaces the stravalib rate limiter, which raises as soon as a response shows the limit is used up
+    session = mount_scheduler(requests.Session(), RequestScheduler(metrics, API_LIMITS, args.rate_limit_wait))
+
+    client = None
+    jwt = load_credentials(args.credentials, config).get('jwt')
+    if jwt is not None:
+        client = resume_web_session(jwt, tokens, session, metrics)
+
+    if client is None:
+        # WebClient logs in to the Strava website when it is created
+        with metrics.time('login'):
+            client = ActivityWebClient(access_token=tokens['access_token'], email=email, password=password,
+                                       rate_limit_requests=False, requests_session=session)
+        metrics.increment('api_calls')
+        save_credentials(args.credentials, config, jwt=client.jwt)
+
+    # Activity files are downloaded from the website, which has no rate limit headers but does answer 429
+    mount_scheduler(client._session, RequestScheduler(metrics, max_wait=args.rate_limit_wait))
+    return client
+
+
+def open_archive(args):
+    if args.no_archive:
+        return contextlib.nullcontext()
+    return FitArchive(args.archive, args.archive_codec)
+
+
+def sync_strava(args, metrics):
+    config_data, config = read_config(args)
+    tokens = get_access_token(args, config_data, config, metrics)
+    client = create_client(args, config, tokens, metrics)
+
+    with SyncState(args.state) as state, WorkoutCache(args.cache, get_parser_version(args.analysis),
+                                                      args.cache_size) as cache, open_archive(args) as archive:
+        if args.rerender:
+            rerender_activities(client, state, cache, metrics, args, archive)
+        elif args.backfill:
+            backfill_activities(client, state, cache, metrics, args, archive)
+        else:
+            sync_latest_activities(client, state, cache, metrics, args, archive)
+
+    counters = metrics.summary()['counters']
+    __log__.info("Updated %d activities, %d were already up to date, %d failed",
+                 counters['activities_updated'], counters['activities_unchanged'], counters['activities_failed'])
+
@@ -0,0 +1,192 @@
+import datetime
+import json
+import os
+import sqlite3
+import threading
+from collections import namedtuple
+
+SyncedActivity = namedtuple('SyncedActivity', ['id', 'start_date', 'upload_id', 'elapsed_time', 'content_hash', 'name',
+                                               'description'])
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS activities (
+    id INTEGER PRIMARY KEY,
+    start_date TEXT,
+    upload_id INTEGER,
+    elapsed_time REAL,
+    content_hash TEXT,
+    name TEXT,
+    description TEXT,
+    synced_at TEXT NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS activities_start_date ON activities (start_date);
+
+CREATE TABLE IF NOT EXISTS sessions (
+    activity_id INTEGER PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    start_date TEXT,
+    metrics TEXT NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS sessions_fingerprint ON sessions (fingerprint, start_date);
+
+CREATE TABLE IF NOT EXISTS failures (
+    activity_id INTEGER PRIMARY KEY,
+    start_date TEXT,
+    error TEXT NOT NULL,
+    attempts INTEGER NOT NULL,
+    failed_at TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS watched_files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    modified REAL NOT NULL,
+    activity_id INTEGER,
+    processed_at TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS backfill (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    before TEXT,
+    completed INTEGER NOT NULL DEFAULT 0
+);
+'''
+
+
+def format_date(date):
+    return None if date is None else date.astimezone(datetime.timezone.utc).isoformat()
+
+
+def parse_date(date):
+    return None if date is None else datetime.datetime.fromisoformat(date)
+
+
+def parse_activity_row(row):
+    elapsed_time = None if row[3] is None else datetime.timedelta(seconds=row[3])
+    return SyncedActivity(row[0], parse_date(row[1]), row[2], elapsed_time, *row[4:])
+
+
+class SyncState:
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        # Pipeline workers may share the state, so every access goes through the lock
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def get_activity(self, activity_id):
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT id, start_date, upload_id, elapsed_time, content_hash, name, description FROM activities '
+                'WHERE id = ?', (activity_id,)).fetchone()
+
+        if row is None:
+            return None
+        return parse_activity_row(row)
+
+    def iter_activities(self):
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT id, start_date, upload_id, elapsed_time, content_hash, name, description FROM activities '
+                'WHERE content_hash IS NOT NULL ORDER BY start_date DESC').fetchall()
+
+        for row in rows:
+            yield parse_activity_row(row)
+
+    def record_activity(self, activity, content_hash, name, description):
+        # The upload id and elapsed time tell whether the activity changed on Strava since it was synced
+        elapsed_time = None if activity.elapsed_time is None else activity.elapsed_time.total_seconds()
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO activities '
+                '(id, start_date, upload_id, elapsed_time, content_hash, name, description, synced_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (activity.id, format_date(activity.start_date), activity.upload_id, elapsed_time, content_hash,
+                 name, description,
+                 format_date(datetime.datetime.now(datetime.timezone.utc))))
+            self.connection.execute('DELETE FROM failures WHERE activity_id = ?', (activity.id,))
+
+    def record_failure(self, activity_id, start_date, error):
+        # Failed activities are not recorded as synced, so the next sync covering them tries them again
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT INTO failures (activity_id, start_date, error, attempts, failed_at) VALUES (?, ?, ?, 1, ?) '
+                'ON CONFLICT (activity_id) DO UPDATE SET error = excluded.error, attempts = attempts + 1, '
+                'failed_at = excluded.failed_at',
+                (activity_id, format_date(start_date), error,
+                 format_date(datetime.datetime.now(datetime.timezone.utc))))
+
+    def get_failure_attempts(self, activity_id):
+        with self.lock:
+            row = self.connection.execute('SELECT attempts FROM failures WHERE activity_id = ?',
+                                          (activity_id,)).fetchone()
+        return 0 if row is None else row[0]
+
+    def iter_failures(self, max_attempts):
+        # The activities that failed fewer than max_attempts times, the others have been given up on
+        with self.lock:
+            rows = self.connection.execute('SELECT activity_id FROM failures WHERE attempts < ? ORDER BY start_date',
+                                           (max_attempts,)).fetchall()
+
+        for row in rows:
+            yield row[0]
+
+    def record_session(self, activity_id, start_date, fingerprint, metrics):
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO sessions (activity_id, fingerprint, start_date, metrics) VALUES (?, ?, ?, ?)',
+                (activity_id, fingerprint, format_date(start_date), json.dumps(metrics)))
+
+    def get_previous_sessions(self, fingerprint, before, limit):
+        # The metrics of the latest sessions with the fingerprint that started before the given date, newest first
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT metrics FROM sessions WHERE fingerprint = ? AND start_date < ? '
+                'ORDER BY start_date DESC LIMIT ?', (fingerprint, format_date(before), limit)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def is_file_processed(self, path, size, modified):
+        with self.lock:
+            row = self.connection.execute('SELECT 1 FROM watched_files WHERE path = ? AND size = ? AND modified = ?',
+                                          (path, size, modified)).fetchone()
+        return row is not None
+
+    def record_file(self, path, size, modified, activity_id):
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO watched_files (path, size, modified, activity_id, processed_at) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (path, size, modified, activity_id, format_date(datetime.datetime.now(datetime.timezone.utc))))
+
+    def latest_start_date(self):
+        with self.lock:
+            row = self.connection.execute('SELECT max(start_date) FROM activities').fetchone()
+        return parse_date(row[0])
+
+    def get_backfill_cursor(self):
+        with self.lock:
+            row = self.connection.execute('SELECT before, completed FROM backfill WHERE id = 0').fetchone()
+
+        if row is None:
+            return None, False
+        return parse_date(row[0]), bool(row[1])
+
+    def set_backfill_cursor(self, before, completed=False):
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO backfill (id, before, completed) VALUES (0, ?, ?)',
+                                    (format_date(before), int(completed)))
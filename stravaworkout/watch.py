@@ -0,0 +1,287 @@
+import collections
+import datetime
+import logging
+import os
+import time
+from collections import namedtuple
+
+from fingerprint import get_session_metrics, get_workout_fingerprint
+from renderer import render_workout
+from spool import ChunkSpool, READ_CHUNK_SIZE
+from sync import (ActivityJob, create_client, get_access_token, get_previous_sessions, open_archive, read_config,
+                  refresh_expiring_token, run_with_metrics, upload_activity, write_metrics)
+from sync_state import SyncState
+from workout_cache import WorkoutCache
+from workout_parser import FIT_EPOCH, create_workout, get_parser_version
+
+__log__ = logging.getLogger(__name__)
+
+DEFAULT_SETTLE_TIME = 5
+DEFAULT_MATCH_INTERVAL = 30
+DEFAULT_MATCH_TOLERANCE = 120
+# The most activities fetched when looking for matches, and the most the fetch interval grows by on misses
+MATCH_FETCH_LIMIT = 30
+MAX_MATCH_BACKOFF = 16
+
+WatchedFile = namedtuple('WatchedFile', ['path', 'size', 'modified'])
+PendingUpload = namedtuple('PendingUpload', ['file', 'start_date', 'content_hash', 'workout', 'fingerprint',
+                                             'session', 'name', 'description', 'queued_at'])
+
+
+class FolderWatcher:
+    # Polls a directory tree for FIT files. A file is reported once its size and modification time have stayed
+    # the same for settle_time seconds, so a file that is still being copied is never read half written.
+    def __init__(self, directory, settle_time=DEFAULT_SETTLE_TIME):
+        self.directory = directory
+        self.settle_time = settle_time
+        self.started_at = time.time()
+        # path -> (size, modified, time it was first seen with that size and modified)
+        self.settling = {}
+        # path -> (size, modified)
+        self.reported = {}
+
+    def scan(self):
+        for directory, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if not filename.lower().endswith('.fit'):
+                    continue
+
+                path = os.path.join(directory, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield path, stat.st_size, stat.st_mtime
+
+    def retry(self, path):
+        # Reported again once it has settled again, such as after it could not be read
+        self.reported.pop(path, None)
+
+    def poll(self, now=None):
+        if now is None:
+            now = time.monotonic()
+
+        complete = []
+        seen = set()
+        for path, size, modified in self.scan():
+            seen.add(path)
+            if size == 0 or self.reported.get(path) == (size, modified):
+                continue
+
+            settling = self.settling.get(path)
+            if settling is None or settling[:2] != (size, modified):
+                self.settling[path] = (size, modified, now)
+            elif now - settling[2] >= self.settle_time:
+                del self.settling[path]
+                self.reported[path] = (size, modified)
+                complete.append(WatchedFile(path, size, modified))
+
+        # Deleted files are forgotten, so a file copied to the same path again is reported again
+        for path in set(self.settling) - seen:
+            del self.settling[path]
+        for path in set(self.reported) - seen:
+            del self.reported[path]
+
+        return complete
+
+
+class ActivityMatcher:
+    # Finds the Strava activity of a local FIT file by its start date. The recent activities are only fetched
+    # while a file has no match, and at most once every interval seconds. The interval doubles with every fetch
+    # that leaves a file unmatched, as a file may never get an activity.
+    def __init__(self, client, metrics, tolerance=DEFAULT_MATCH_TOLERANCE, interval=DEFAULT_MATCH_INTERVAL):
+        self.client = client
+        self.metrics = metrics
+        self.tolerance = datetime.timedelta(seconds=tolerance)
+        self.interval = interval
+        self.activities = []
+        self.fetched_at = None
+        self.misses = 0
+
+    def find(self, start_date):
+        activities = [x for x in self.activities if abs(x.start_date - start_date) <= self.tolerance]
+        if len(activities) == 0:
+            return None
+        return min(activities, key=lambda x: abs(x.start_date - start_date))
+
+    def fetch(self, after, now=None):
+        if now is None:
+            now = time.monotonic()
+        interval = self.interval * min(2 ** self.misses, MAX_MATCH_BACKOFF)
+        if self.fetched_at is not None and now - self.fetched_at < interval:
+            return False
+
+        self.fetched_at = now
+        with self.metrics.time('get_activities'):
+            self.activities = list(self.client.get_activities(after=after - self.tolerance, limit=MATCH_FETCH_LIMIT))
+        self.metrics.increment('api_calls')
+        return True
+
+
+def get_workout_start_date(workout):
+    start_times = [lap.start_time for work_step in workout.work_steps.values() for repeat in work_step.repeats
+                   for lap in repeat.laps if lap.start_time is not None]
+    if len(start_times) == 0:
+        return None
+    return FIT_EPOCH + datetime.timedelta(seconds=min(start_times))
+
+
+def read_watched_file(watched_file, decoder, analysis, cache, metrics, state=None, compare_sessions=0, archive=None):
+    stats = collections.Counter()
+    with open(watched_file.path, 'rb') as f, ChunkSpool(iter(lambda: f.read(READ_CHUNK_SIZE), b'')) as file:
+        with metrics.time('decode'), metrics.profile():
+            workout = create_workout(file, decoder, stats)
+            content_hash = file.content_hash()
+
+        if analysis and workout is not None:
+            from analysis import analyse_workout
+            with metrics.time('analysis'):
+                analyse_workout(file, workout)
+
+        # Kept for re-analysis, the watched directory may be cleared out by the device or its sync tool
+        if archive is not None and workout is not None:
+            with metrics.time('archive'):
+                archive.put(content_hash, file.iter_chunks())
+    metrics.update(stats)
+    metrics.increment('files_watched')
+
+    if workout is None:
+        __log__.info("No workout found in %s", watched_file.path)
+        return None
+
+    start_date = get_workout_start_date(workout)
+    if start_date is None:
+        __log__.info("No lap start times found in %s", watched_file.path)
+        return None
+
+    cache.put(content_hash, workout)
+    with metrics.time('render'):
+        fingerprint = get_workout_fingerprint(workout)
+        session = get_session_metrics(workout)
+        previous_sessions = get_previous_sessions(state, fingerprint, start_date, compare_sessions)
+        rendering = render_workout(workout, previous_sessions=previous_sessions)
+
+    return PendingUpload(watched_file, start_date, content_hash, workout, fingerprint, session, rendering.title,
+                         rendering.description, time.monotonic())
+
+
+def upload_matched(client, state, metrics, upload, activity, force_update=False):
+    # Only runs are synced, as in create_activity_jobs
+    if activity.type == 'Run':
+        job = ActivityJob(activity, state.get_activity(activity.id))
+        job.content_hash = upload.content_hash
+        job.workout = upload.workout
+        job.name = upload.name
+        job.description = upload.description
+        upload_activity(client, metrics, job, force_update)
+
+        metrics.increment('activities_processed')
+        state.record_activity(activity, job.content_hash, job.name, job.description)
+        state.record_session(activity.id, activity.start_date, upload.fingerprint, upload.session)
+        if job.updated:
+            print(job.name)
+            print(job.description)
+            print()
+
+    state.record_file(*upload.file, activity.id)
+
+
+def upload_pending(client, state, matcher, metrics, pending, args):
+    now = time.monotonic()
+    if any(map(lambda x: matcher.find(x.start_date) is None, pending)):
+        if matcher.fetch(min(map(lambda x: x.start_date, pending)), now):
+            unmatched = any(map(lambda x: matcher.find(x.start_date) is None, pending))
+            matcher.misses = matcher.misses + 1 if unmatched else 0
+
+    still_pending = []
+    for upload in pending:
+        activity = matcher.find(upload.start_date)
+        if activity is None:
+            if now - upload.queued_at < args.match_timeout:
+                still_pending.append(upload)
+            else:
+                __log__.warning("No Strava activity found for %s starting at %s",
+                                upload.file.path, upload.start_date)
+                state.record_file(*upload.file, None)
+            continue
+
+        try:
+            upload_matched(client, state, metrics, upload, activity, args.force_update)
+        except Exception:
+            # The daemon keeps running, the upload is retried on the next poll
+            __log__.warning("Failed to update activity %s from %s", activity.id, upload.file.path, exc_info=True)
+            still_pending.append(upload)
+
+    return still_pending
+
+
+def watch_strava(args, metrics):
+    config_data, config = read_config(args)
+    tokens = get_access_token(args, config_data, config, metrics)
+    client = create_client(args, config, tokens, metrics)
+
+    watcher = FolderWatcher(args.directory, args.settle_time)
+    matcher = ActivityMatcher(client, metrics, args.match_tolerance, args.match_interval)
+
+    with SyncState(args.state) as state, WorkoutCache(args.cache, get_parser_version(args.analysis),
+                                                      args.cache_size) as cache, open_archive(args) as archive:
+        __log__.info("Watching %s for FIT files", args.directory)
+        try:
+            watch_folder(client, state, cache, archive, metrics, watcher, matcher, args, config_data, config,
+                         tokens)
+        except KeyboardInterrupt:
+            # Interrupting is how the daemon is stopped, so it is not a failed run
+            __log__.info("Stopped watching %s", args.directory)
+
+
+def watch_folder(client, state, cache, archive, metrics, watcher, matcher, args, config_data, config, tokens):
+    pending = []
+    tolerance = datetime.timedelta(seconds=args.match_tolerance)
+    while True:
+        tokens = refresh_expiring_token(client, args, config_data, config, metrics, tokens)
+
+        # Metrics are written whenever something happened, as the daemon may never exit
+        changed = False
+        for watched_file in watcher.poll():
+            if state.is_file_processed(*watched_file):
+                continue
+
+            # Older workouts are left to the sync and its lookback, so a folder of old files does not keep the
+            # matcher fetching. Without a synced activity, that is every file already there when the watch started.
+            changed = True
+            latest = state.latest_start_date()
+            if latest is None and watched_file.modified < watcher.started_at:
+                __log__.info("Skipped %s, it was there before the watch started", watched_file.path)
+                continue
+
+            # Only files that were parsed are recorded, a file that could not be read is tried again
+            try:
+                upload = read_watched_file(watched_file, args.decoder, args.analysis, cache, metrics, state,
+                                           args.compare_sessions, archive)
+            except Exception:
+                __log__.warning("Failed to read %s, it is tried again", watched_file.path, exc_info=True)
+                watcher.retry(watched_file.path)
+                continue
+
+            if upload is not None and latest is not None and upload.start_date < latest - tolerance:
+                __log__.info("Skipped %s, it started before the latest synced activity", watched_file.path)
+                upload = None
+
+            if upload is None:
+                state.record_file(*watched_file, None)
+            else:
+                pending.append(upload)
+
+        if pending:
+            still_pending = upload_pending(client, state, matcher, metrics, pending, args)
+            changed = changed or len(still_pending) != len(pending)
+            pending = still_pending
+
+        if changed:
+            write_metrics(metrics, args)
+
+        time.sleep(args.poll_interval)
+
+
+def watch_main(args):
+    run_with_metrics(watch_strava, args)
@@ -0,0 +1,207 @@
+import http.server
+import json
+import logging
+import queue
+import threading
+import time
+import urllib.parse
+from collections import namedtuple
+
+from stravalib import Client
+
+from sync import (create_activity_jobs, create_client, get_access_token, open_archive, read_config,
+                  refresh_expiring_token, run_with_metrics, sync_activities, write_metrics)
+from sync_state import SyncState
+from workout_cache import WorkoutCache
+from workout_parser import get_parser_version
+
+__log__ = logging.getLogger(__name__)
+
+DEFAULT_HOST = 'localhost'
+DEFAULT_PORT = 8080
+DEFAULT_BATCH_DELAY = 2
+ASPECT_TYPES = ('create', 'update')
+
+WebhookEvent = namedtuple('WebhookEvent', ['object_id', 'aspect_type', 'owner_id', 'updates', 'event_time'])
+
+
+def parse_event(body):
+    # Only activity creates and updates are returned, other events such as deletes and deauthorisations are None
+    try:
+        event = json.loads(body)
+        if event['object_type'] != 'activity' or event['aspect_type'] not in ASPECT_TYPES:
+            return None
+        return WebhookEvent(int(event['object_id']), event['aspect_type'], int(event['owner_id']),
+                            event.get('updates') or {}, event.get('event_time'))
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError(f"Invalid webhook event: {e}") from e
+
+
+class WebhookHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        # The subscription handshake, Strava checks the verify token is ours and expects the challenge echoed back
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        mode = query.get('hub.mode', [None])[0]
+        verify_token = query.get('hub.verify_token', [None])[0]
+        challenge = query.get('hub.challenge', [None])[0]
+        if mode != 'subscribe' or verify_token != self.server.verify_token or challenge is None:
+            __log__.warning("Rejected a subscription handshake from %s", self.client_address[0])
+            self.send_json(403, {'error': "Invalid verify token"})
+            return
+
+        __log__.info("Accepted the subscription handshake")
+        self.send_json(200, {'hub.challenge': challenge})
+
+    def do_POST(self):
+        # Strava retries an event that is not acknowledged within two seconds, so events are only queued here
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            event = parse_event(body)
+        except ValueError as e:
+            __log__.warning("%s", e)
+            self.send_json(400, {'error': str(e)})
+            return
+
+        if event is not None:
+            self.server.metrics.increment('webhook_events')
+            self.server.events.put(event)
+        self.send_json(200, {})
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        __log__.debug("%s %s", self.client_address[0], format % args)
+
+
+class WebhookServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, verify_token, events, metrics):
+        super().__init__(address, WebhookHandler)
+        self.verify_token = verify_token
+        self.events = events
+        self.metrics = metrics
+
+
+def receive_events(events, batch_delay=DEFAULT_BATCH_DELAY):
+    # Blocks for the first event, then gathers the events arriving within batch_delay seconds of it, as an
+    # activity is often updated right after it was created
+    batch = [events.get()]
+    deadline = time.monotonic() + batch_delay
+    while True:
+        timeout = deadline - time.monotonic()
+        if timeout <= 0:
+            break
+        try:
+            batch.append(events.get(timeout=timeout))
+        except queue.Empty:
+            break
+    return batch
+
+
+def is_own_update(state, event):
+    # Updating the title of an activity sends an update event for it, which is skipped when the title is ours
+    if event.aspect_type != 'update' or set(event.updates) != {'title'}:
+        return False
+    previous = state.get_activity(event.object_id)
+    return previous is not None and previous.name == event.updates['title']
+
+
+def get_event_activities(client, state, metrics, athlete_id, events):
+    activity_ids = []
+    for event in events:
+        if event.owner_id != athlete_id:
+            __log__.info("Skipped activity %s of athlete %s", event.object_id, event.owner_id)
+        elif not is_own_update(state, event) and event.object_id not in activity_ids:
+            activity_ids.append(event.object_id)
+
+    activities = []
+    for activity_id in activity_ids:
+        try:
+            with metrics.time('get_activity'):
+                activities.append(client.get_activity(activity_id))
+        except Exception:
+            # The activity may have been deleted or made private since the event was sent
+            __log__.warning("Failed to get activity %s", activity_id, exc_info=True)
+        metrics.increment('api_calls')
+    return activities
+
+
+def process_events(client, state, cache, archive, metrics, athlete_id, events, args, config_data, config, tokens):
+    while True:
+        # The receiver runs until it is interrupted
+        batch = receive_events(events, args.batch_delay)
+        tokens = refresh_expiring_token(client, args, config_data, config, metrics, tokens)
+        try:
+            activities = get_event_activities(client, state, metrics, athlete_id, batch)
+            # Synced activities are processed again on an update, their workout usually comes from the cache
+            # and they are only uploaded when the title or description changed
+            # An event is a new reason to try an activity that was given up on
+            jobs = create_activity_jobs(activities, state, True, skip_given_up=False)
+            sync_activities(client, state, cache, metrics, jobs, args, archive)
+        except Exception:
+            # The receiver keeps running, Strava does not send the events again
+            __log__.warning("Failed to process activities %s", list(map(lambda x: x.object_id, batch)),
+                            exc_info=True)
+        # Metrics are written after every batch, as the receiver may never exit
+        write_metrics(metrics, args)
+
+
+def subscribe(config, callback_url, verify_token, metrics):
+    # Strava checks the callback with the handshake before answering, so the server must already be running
+    client_id = int(config['api']['client_id'])
+    client_secret = config['api']['client_secret']
+    with metrics.time('subscribe'):
+        subscription = Client().create_subscription(client_id, client_secret, callback_url, verify_token)
+    metrics.increment('api_calls')
+    __log__.info("Subscribed %s as push subscription %s", callback_url, subscription.id)
+
+
+def get_verify_token(args, config):
+    verify_token = args.verify_token or config.get('webhook', 'verify_token', fallback=None)
+    if not verify_token:
+        raise ValueError("A verify token is needed, pass --verify-token or set verify_token in the [webhook] section")
+    return verify_token
+
+
+def webhook_strava(args, metrics):
+    config_data, config = read_config(args)
+    verify_token = get_verify_token(args, config)
+    tokens = get_access_token(args, config_data, config, metrics)
+    client = create_client(args, config, tokens, metrics)
+
+    # Events of other athletes who authorised the same application are skipped, the tokens are only for this one
+    with metrics.time('get_athlete'):
+        athlete_id = client.get_athlete().id
+    metrics.increment('api_calls')
+
+    events = queue.Queue()
+    server = WebhookServer((args.host, args.port), verify_token, events, metrics)
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+
+    with SyncState(args.state) as state, WorkoutCache(args.cache, get_parser_version(args.analysis),
+                                                      args.cache_size) as cache, open_archive(args) as archive:
+        __log__.info("Receiving webhook events for athlete %s on %s:%s", athlete_id, *server.server_address[:2])
+        try:
+            if args.subscribe is not None:
+                subscribe(config, args.subscribe, verify_token, metrics)
+            process_events(client, state, cache, archive, metrics, athlete_id, events, args, config_data, config,
+                           tokens)
+        except KeyboardInterrupt:
+            # Interrupting is how the receiver is stopped, so it is not a failed run
+            __log__.info("Stopped receiving webhook events")
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+def webhook_main(args):
+    run_with_metrics(webhook_strava, args)
+
@@ -0,0 +1,25 @@
+import json
+import time
+import urllib.request
+
+
+def post_event(url, object_id, owner_id, aspect_type='create', updates=None):
+    # Stands in for Strava by posting an activity event to a running receiver
+    event = {
+        'object_type': 'activity',
+        'object_id': object_id,
+        'aspect_type': aspect_type,
+        'owner_id': owner_id,
+        'subscription_id': 0,
+        'event_time': int(time.time()),
+        'updates': updates or {},
+    }
+    request = urllib.request.Request(url, json.dumps(event).encode(), {'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request) as response:
+        return response.status
+
+
+def post_event_main(args):
+    updates = {} if args.title is None else {'title': args.title}
+    status = post_event(args.url, args.activity_id, args.owner_id, args.aspect_type, updates)
+    print(f"Posted {args.aspect_type} event for activity {args.activity_id}: HTTP {status}")
@@ -0,0 +1,89 @@
+import os
+import pickle
+import sqlite3
+import threading
+import zlib
+
+DEFAULT_CACHE_SIZE = 64 * 1024 * 1024
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS parsed_workouts (
+    content_hash TEXT NOT NULL,
+    parser_version TEXT NOT NULL,
+    data BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    last_used INTEGER NOT NULL,
+    PRIMARY KEY (content_hash, parser_version)
+);
+
+CREATE INDEX IF NOT EXISTS parsed_workouts_last_used ON parsed_workouts (last_used);
+'''
+
+MISSING = object()
+
+
+class WorkoutCache:
+    # Parsed workouts keyed by the content hash of their FIT file, least recently used entries are evicted
+    # once the cache grows beyond max_size bytes. Entries of other parser versions are kept until evicted, as
+    # runs with and without --analysis parse with different versions and would otherwise empty the cache.
+    def __init__(self, path, parser_version, max_size=DEFAULT_CACHE_SIZE):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.parser_version = parser_version
+        self.max_size = max_size
+        # last_used is a counter rather than a time, so entries used in quick succession are still ordered.
+        # Pipeline workers may share the cache, so every access goes through the lock
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def get(self, content_hash, default=MISSING):
+        with self.lock, self.connection:
+            row = self.connection.execute(
+                'SELECT data FROM parsed_workouts WHERE content_hash = ? AND parser_version = ?',
+                (content_hash, self.parser_version)).fetchone()
+            if row is None:
+                return default
+
+            self.connection.execute(
+                'UPDATE parsed_workouts SET last_used = (SELECT max(last_used) + 1 FROM parsed_workouts) '
+                'WHERE content_hash = ? AND parser_version = ?', (content_hash, self.parser_version))
+
+        return pickle.loads(zlib.decompress(row[0]))
+
+    def put(self, content_hash, workout):
+        data = zlib.compress(pickle.dumps(workout, pickle.HIGHEST_PROTOCOL))
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO parsed_workouts (content_hash, parser_version, data, size, last_used) '
+                'VALUES (?, ?, ?, ?, (SELECT coalesce(max(last_used), 0) + 1 FROM parsed_workouts))',
+                (content_hash, self.parser_version, data, len(data)))
+            self._evict()
+
+    def _evict(self):
+        total_size, = self.connection.execute('SELECT coalesce(sum(size), 0) FROM parsed_workouts').fetchone()
+        if total_size <= self.max_size:
+            return
+
+        evicted = []
+        for content_hash, parser_version, size in self.connection.execute(
+                'SELECT content_hash, parser_version, size FROM parsed_workouts ORDER BY last_used'):
+            if total_size <= self.max_size:
+                break
+            evicted.append((content_hash, parser_version))
+            total_size -= size
+
+        self.connection.executemany('DELETE FROM parsed_workouts WHERE content_hash = ? AND parser_version = ?',
+                                    evicted)
@@ -0,0 +1,269 @@
+import datetime
+import hashlib
+import logging
+
+import fit_decoder
+import workout_types
+from fit_decoder import iter_messages, iter_stream_messages, FitDecodeError, FitMessage, MissingFieldError
+from spool import ChunkSpool
+from workout_types import Workout, WorkStep, WorkStepRepeat, Lap
+
+__log__ = logging.getLogger(__name__)
+
+DECODERS = ('fast', 'fitdecode')
+
+FIT_EPOCH = datetime.datetime(1989, 12, 31, tzinfo=datetime.timezone.utc)
+
+
+class FrameValues(dict):
+    def __init__(self, frame):
+        # The first field wins, matching fitdecode's own get_field
+        super().__init__((field.name, field.value) for field in reversed(frame.fields))
+        self.name = frame.name
+
+    def __missing__(self, field_name):
+        raise MissingFieldError(f"Field \"{field_name}\" not found in {self.name} message")
+
+
+def get_frame_values(frame):
+    # Fast decoder messages resolve fields through accessors compiled once per definition message
+    if isinstance(frame, FitMessage):
+        return frame
+
+    return FrameValues(frame)
+
+
+def get_fit_timestamp(value):
+    # The fast decoder leaves timestamps as seconds since the FIT epoch, fitdecode converts them to datetimes
+    if isinstance(value, datetime.datetime):
+        return (value - FIT_EPOCH).total_seconds()
+    return value
+
+
+def get_workout_step_by_index(workout, index):
+    return workout.get_work_step(index)
+
+
+def iter_fitdecode_frames(file, stats=None):
+    # fitdecode is only needed when falling back or asked for, so it is not loaded up front
+    import fitdecode
+
+    with fitdecode.FitReader(file) as fit:
+        for frame in fit:
+            if frame.frame_type == fitdecode.FIT_FRAME_DATA:
+                if stats is not None:
+                    stats['frames_decoded'] += 1
+                yield frame
+
+
+def iter_workout_frames(file, decoder='fast', stats=None):
+    if decoder == 'fast' and isinstance(file, ChunkSpool):
+        return iter_stream_messages(file.iter_chunks(), stats=stats)
+    elif decoder == 'fast':
+        return iter_messages(file, stats=stats)
+    elif decoder == 'fitdecode':
+        return iter_fitdecode_frames(file, stats)
+    else:
+        raise ValueError(f"Unknown decoder \"{decoder}\"")
+
+
+def create_lap(fields):
+    return Lap(
+        fields['total_distance'],
+        datetime.timedelta(seconds=fields['total_elapsed_time']),
+        fields['enhanced_avg_speed'],
+        fields['avg_heart_rate'],
+        fields['total_ascent'],
+        fields['total_descent'],
+        get_fit_timestamp(fields.get('start_time')),
+        get_fit_timestamp(fields.get('timestamp')),
+    )
+
+
+class WorkoutBuilder:
+    # Builds the workout as the frames are decoded, every frame becomes a step or lap as it arrives and is then
+    # dropped, so what is held does not grow with the records of the file.
+    # A multi-session or chained file can hold several workouts, each numbering its steps from 0 again. Their steps
+    # are added to the one workout after the earlier ones, with the indexes offset to follow on. The next workout
+    # starts at the file_id of a chained file, so its laps are held until its steps arrive, or at a step index that
+    # does not follow on within a file.
+    def __init__(self):
+        self.workout = None
+        self.weight = None
+        self.index_offset = 0
+        self.last_step_index = None
+        # Laps read before any step of their workout, as (wkt_step_index, Lap)
+        self.pending_laps = []
+        self.last_lap_step_index = None
+        self.laps_ended = False
+        self.laps_attributed = 0
+
+    def add_frame(self, frame):
+        if frame.name == 'file_id':
+            self.add_file_id()
+        elif frame.name == 'lap':
+            self.add_lap(get_frame_values(frame))
+        elif frame.name == 'workout_step':
+            self.add_workout_step(get_frame_values(frame))
+        elif frame.name == 'user_profile':
+            self.add_user_profile(get_frame_values(frame))
+
+    def add_file_id(self):
+        if self.last_step_index is not None:
+            self.start_next_workout()
+
+    def add_user_profile(self, fields):
+        # Every session of a multi-session file may repeat the profile, the first weight is used
+        if self.weight is None:
+            self.weight = fields.get('weight')
+            if self.workout is not None:
+                self.workout.profile = self.weight
+
+    def add_workout_step(self, fields):
+        index = fields['message_index']
+        if self.last_step_index is not None and index <= self.last_step_index:
+            self.start_next_workout()
+        self.last_step_index = index
+
+        if self.workout is None:
+            self.workout = Workout(self.weight, [])
+        index += self.index_offset
+
+        workout_step_type = fields['intensity']
+        workout_step_duration_type = fields['duration_type']
+
+        # TODO: Hack for Garmin recommended workout
+        if workout_step_type == 'active' and workout_step_duration_type == 'repeat_until_steps_cmplt':
+            workout_step_type = None
+
+        # TODO: need to see how this works in other files
+        if workout_step_type is None and workout_step_duration_type == 'repeat_until_steps_cmplt':
+            self.workout.add_repeat_step(index,
+                                         workout_step_type,
+                                         fields['repeat_steps'],
+                                         fields['duration_step'] + self.index_offset)
+
+        else:
+            workout_step = WorkStep(index,
+                                    workout_step_type,
+                                    workout_step_duration_type,
+                                    None,
+                                    fields['target_type'])
+
+            if workout_step.duration_type == 'time':
+                workout_step.duration = datetime.timedelta(
+                    seconds=fields['duration_time'])
+            elif workout_step.duration_type == 'distance':
+                workout_step.duration = fields['duration_distance']
+            elif workout_step.duration_type == 'hr_less_than':
+                workout_step.duration = fields['duration_hr'] - 100  # TODO: 210 vs 110
+            elif workout_step.duration_type == 'open':
+                pass
+            elif workout_step.duration_type is None:
+                pass
+            else:
+                raise ValueError(f"Unknown duration_type \"{workout_step.duration_type}\"")
+
+            if workout_step.target_type == 'speed':
+                workout_step.target_low = fields['custom_target_speed_low']
+                workout_step.target_high = fields['custom_target_speed_high']
+            elif workout_step.target_type == 'heart_rate':
+                workout_step.target_zone = fields['target_hr_zone']
+                workout_step.target_low = fields['custom_target_heart_rate_low']
+                workout_step.target_high = fields['custom_target_heart_rate_high']
+            elif workout_step.target_type == 'open':
+                pass
+            elif workout_step.target_type is None:
+                pass
+            else:
+                raise ValueError(f"Unknown target_type \"{workout_step.target_type}\"")
+
+            self.workout.add_step(workout_step)
+
+    def add_lap(self, fields):
+        if self.laps_ended:
+            return
+
+        step_index = fields.get('wkt_step_index')
+        if self.last_step_index is None:
+            # Laps outside of any workout have no step index and are never needed
+            if step_index is not None:
+                self.pending_laps.append((step_index, create_lap(fields)))
+            return
+
+        self.attribute_pending_laps()
+        workout_step = self.find_lap_step(step_index)
+        if workout_step is not None:
+            self.attribute_lap(workout_step, create_lap(fields))
+
+    def find_lap_step(self, step_index):
+        # The first lap past the end of the workout ends it, later laps are not part of it
+        if not self.laps_ended and step_index is not None:
+            workout_step = get_workout_step_by_index(self.workout, step_index + self.index_offset)
+            if workout_step is not None:
+                return workout_step
+        self.laps_ended = True
+        return None
+
+    def attribute_lap(self, workout_step, lap):
+        if workout_step.index != self.last_lap_step_index:
+            self.last_lap_step_index = workout_step.index
+            workout_step.repeats.append(WorkStepRepeat([]))
+
+        workout_step.repeats[-1].add_lap(lap)
+        self.laps_attributed += 1
+
+    def attribute_pending_laps(self):
+        pending_laps, self.pending_laps = self.pending_laps, []
+        for step_index, lap in pending_laps:
+            workout_step = self.find_lap_step(step_index)
+            if workout_step is not None:
+                self.attribute_lap(workout_step, lap)
+
+    def start_next_workout(self):
+        self.attribute_pending_laps()
+        self.index_offset += self.last_step_index + 1
+        self.last_step_index = None
+        self.last_lap_step_index = None
+        self.laps_ended = False
+
+    def finish(self):
+        if self.workout is not None:
+            self.attribute_pending_laps()
+        return self.workout
+
+
+def build_workout(frames):
+    builder = WorkoutBuilder()
+    for frame in frames:
+        builder.add_frame(frame)
+    return builder.finish(), builder.laps_attributed
+
+
+# TODO: check workout exists or return None, check it is running
+def create_workout(file, decoder='fast', stats=None):
+    try:
+        workout, laps_attributed = build_workout(iter_workout_frames(file, decoder, stats))
+    except FitDecodeError as e:
+        # fitdecode handles more of the FIT protocol, so fall back to it rather than giving up
+        __log__.warning("Fast FIT decoder failed, falling back to fitdecode: %s", e)
+        if hasattr(file, 'seek'):
+            file.seek(0, 0)
+        workout, laps_attributed = build_workout(iter_workout_frames(file, 'fitdecode', stats))
+
+    if stats is not None:
+        stats['laps_attributed'] += laps_attributed
+    return workout
+
+
+def get_parser_version(analysis=False):
+    import inspect
+
+    # Cached workouts are only valid for the code that parsed them, so the version is a hash of that code
+    sources = [inspect.getsource(x) for x in (fit_decoder, workout_types, FrameValues, get_frame_values,
+                                              iter_workout_frames, create_lap, WorkoutBuilder, build_workout,
+                                              create_workout, get_fit_timestamp)]
+    if analysis:
+        import analysis as analysis_module
+        sources.append(inspect.getsource(analysis_module))
+    return hashlib.sha256(str.join('\n', sources).encode()).hexdigest()
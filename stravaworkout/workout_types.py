@@ -1,14 +1,42 @@
-import operator
-from functools import reduce
-from statistics import mean
-
 from format_utils import *
 
 
 class Workout:
     def __init__(self, profile, steps):
         self.profile = profile
-        self.steps = steps
+        self.steps = []
+        self.work_steps = {}
+        for step in steps:
+            self.add_step(step)
+
+    def add_step(self, step):
+        self.steps.append(step)
+        self._index_step(step)
+
+    def add_repeat_step(self, index, step_type, repeat_times, first_step_index):
+        # The repeat step follows the steps it repeats, so it absorbs the trailing steps from first_step_index.
+        # They stay in work_steps as absorbing only moves them in the tree.
+        num_steps_to_repeat = 0
+        while num_steps_to_repeat < len(self.steps) and self.steps[-num_steps_to_repeat - 1].index >= first_step_index:
+            num_steps_to_repeat += 1
+        assert num_steps_to_repeat > 0
+
+        repeat_step = RepeatStep(index, step_type, repeat_times, self.steps[-num_steps_to_repeat:])
+        del self.steps[-num_steps_to_repeat:]
+        self.steps.append(repeat_step)
+        return repeat_step
+
+    def _index_step(self, step):
+        if isinstance(step, WorkStep):
+            self.work_steps[step.index] = step
+        elif isinstance(step, RepeatStep):
+            for child_step in step.steps:
+                self._index_step(child_step)
+        else:
+            raise ValueError(f"type(step) = {type(step)}")
+
+    def get_work_step(self, index):
+        return self.work_steps.get(index)
 
     def description(self, include_profile=True, include_warmup_cooldown=True,
                     include_duration=True, include_target=True, include_repeats=True):
@@ -62,13 +90,12 @@ class WorkStep(BaseStep):
         return self.repeats_total_distance() / len(self.repeats)
 
     def repeats_avg_total_time(self):
-        return datetime.timedelta(seconds=
-                                  sum(map(lambda x: x.total_time().total_seconds(), self.repeats)) / len(self.repeats))
+        return datetime.timedelta(seconds=sum(map(lambda x: x.total_seconds(), self.repeats)) / len(self.repeats))
 
     # TODO: get speed from distance and time?
     def repeats_avg_avg_speed(self):
-        return (sum(map(lambda x: x.avg_speed() * x.total_time().total_seconds(), self.repeats))
-                / sum(map(lambda x: x.total_time().total_seconds(), self.repeats)))
+        return (sum(map(lambda x: x.avg_speed() * x.total_seconds(), self.repeats))
+                / sum(map(lambda x: x.total_seconds(), self.repeats)))
 
     def description(self, include_duration=True, include_target=True, include_repeats=True):
         description = ''
@@ -80,11 +107,8 @@ class WorkStep(BaseStep):
                            f'{format_speed_as_pace(self.repeats_avg_avg_speed())}'
         elif self.step_type == 'active' or self.step_type == 'interval' or self.step_type == 'recovery' or self.step_type == 'rest':
             if not include_duration and not include_target and not include_repeats:
-                avg_total_distance = sum(map(lambda x: x.total_distance(), self.repeats)) / len(self.repeats)
-                avg_speed = sum(map(lambda x: x.avg_speed() * x.total_time(), self.repeats)) / sum(
-                    map(lambda x: x.total_time(), self.repeats))
-
-                description += f'{format_distance(avg_total_distance)} @ {format_speed_as_pace(avg_speed)}'
+                description += f'{format_distance(self.repeats_avg_total_distance())} @ ' \
+                               f'{format_speed_as_pace(self.repeats_avg_avg_speed())}'
                 return description
 
             if self.duration_type == 'time':
@@ -131,27 +155,66 @@ class RepeatStep(BaseStep):
 
 
 class WorkStepRepeat:
+    # Totals are kept up to date as laps are added, so add laps with add_lap rather than appending to laps.
+    # Distance, speed, heart rate, ascent and descent become None once a lap without them is added.
+    # analysis is set by the optional record analysis in analysis.py.
+    __slots__ = ('laps', 'analysis', '_total_distance', '_total_seconds', '_speed_distance', '_heart_rate_seconds',
+                 '_total_ascent', '_total_descent')
+
     def __init__(self, laps):
-        self.laps = laps
+        self.laps = []
+        self.analysis = None
+        self._total_distance = 0
+        self._total_seconds = 0
+        self._speed_distance = 0
+        self._heart_rate_seconds = 0
+        self._total_ascent = 0
+        self._total_descent = 0
+        for lap in laps:
+            self.add_lap(lap)
+
+    def add_lap(self, lap):
+        lap_seconds = lap.total_time.total_seconds()
+        self.laps.append(lap)
+        self._total_seconds += lap_seconds
+        if self._total_distance is not None:
+            self._total_distance = None if lap.total_distance is None \
+                else self._total_distance + lap.total_distance
+        if self._speed_distance is not None:
+            self._speed_distance = None if lap.avg_speed is None or lap.total_distance is None \
+                else self._speed_distance + lap.avg_speed * lap.total_distance
+        if self._heart_rate_seconds is not None:
+            self._heart_rate_seconds = None if lap.avg_heart_rate is None \
+                else self._heart_rate_seconds + lap.avg_heart_rate * lap_seconds
+        if self._total_ascent is not None:
+            self._total_ascent = None if lap.total_ascent is None else self._total_ascent + lap.total_ascent
+        if self._total_descent is not None:
+            self._total_descent = None if lap.total_descent is None else self._total_descent + lap.total_descent
 
     def total_distance(self):
-        return sum(map(lambda x: x.total_distance, self.laps))
+        return self._total_distance
+
+    def total_seconds(self):
+        return self._total_seconds
 
     def total_time(self):
-        return datetime.timedelta(seconds=sum(map(lambda x: x.total_time.total_seconds(), self.laps)))
+        return datetime.timedelta(seconds=self._total_seconds)
 
     def avg_speed(self):
-        return sum(map(lambda x: x.avg_speed * x.total_distance, self.laps)) / self.total_distance()
+        if self._speed_distance is None:
+            return None
+        return self._speed_distance / self._total_distance
 
     def avg_heart_rate(self):
-        return (sum(map(lambda x: x.avg_heart_rate * x.total_time.total_seconds(), self.laps))
-                / self.total_time().total_seconds())
+        if self._heart_rate_seconds is None:
+            return None
+        return self._heart_rate_seconds / self._total_seconds
 
     def total_ascent(self):
-        return sum(map(lambda x: x.total_ascent, self.laps))
+        return self._total_ascent
 
     def total_descent(self):
-        return sum(map(lambda x: x.total_descent, self.laps))
+        return self._total_descent
 
     def description(self, include_distance=True, include_heart_rate=True):
         description = ''
@@ -170,10 +233,17 @@ class WorkStepRepeat:
 
 
 class Lap:
-    def __init__(self, total_distance, total_time, avg_speed, avg_heart_rate, total_ascent, total_descent):
+    # start_time and end_time are seconds since the FIT epoch
+    __slots__ = ('total_distance', 'total_time', 'avg_speed', 'avg_heart_rate', 'total_ascent', 'total_descent',
+                 'start_time', 'end_time')
+
+    def __init__(self, total_distance, total_time, avg_speed, avg_heart_rate, total_ascent, total_descent,
+                 start_time=None, end_time=None):
         self.total_distance = total_distance
         self.total_time = total_time
         self.avg_speed = avg_speed
         self.avg_heart_rate = avg_heart_rate
         self.total_ascent = total_ascent
         self.total_descent = total_descent
+        self.start_time = start_time
+        self.end_time = end_time